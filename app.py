@@ -1,10 +1,57 @@
+import colorsys
+import json
+import logging
+import os
+import time
 import folium
+from folium import plugins
+import numpy as np
+import pandas
 import streamlit as st
 import streamlit_folium as stf
-from data_analysis import *
-from cloud import *
+from data_analysis import closest_regions, make_profile_card, make_queried_json_concurrently, point_profile_json
+from cloud import dataset_version, soil_aggregation
+from backends import EarthEngineBackend
+from local_raster import LocalRasterBackend
+from metrics import LogSink, metrics, serve_prometheus
+from point_cache import make_point_cache
+from catalogue import ProfileCatalogue
+from similarity_raster import SimilarityRaster
+from jobs import JobRunner
+from service import ServiceClient, ServiceError
+from tiles import TileRenderer, layer_urls, serve_tiles
+from soil import aggregation_weights, depth_bands
+from scoring import features
+
+logger = logging.getLogger('vineyard.app')
 
 title = 'Vineyard Site Selection'
+# How a click is queried, "combined" samples one stacked image, "concurrent" runs the individual lookups in parallel,
+# "async" runs them in the background (jobs.py) and fills the results in as each one finishes,
+# "service" sends them to the scoring service (python service.py) listening on service.service_address.
+query_mode = 'combined'
+# SQLite file shared by every worker process for cached click results, set to None to cache in memory only.
+point_cache_path = 'cache/points.sqlite'
+# Output of similarity_raster.py, clicks inside it are answered without calling Earth Engine.
+similarity_raster_path = 'similarity'
+# Locally exported rasters (local_raster.py), when present clicks are answered from them instead of Earth Engine.
+local_raster_path = 'rasters'
+# Data layers (tiles.py) on the map: sand, clay, organic carbon, elevation, temperature, diurnal range and the
+# similarity score. With tiles_port set they go through a tile server caching every tile on disk, otherwise the
+# Earth Engine layers are loaded straight from Earth Engine and the similarity layer is left out.
+# The server listens on tiles_host. Browsers load tiles from tiles_url, which defaults to http://localhost:{tiles_port}
+# and so only works for a browser on the same machine. Once deployed, set it to the public URL proxied to the server.
+show_tile_layers = False
+tiles_port = None
+tiles_host = '127.0.0.1'
+tiles_url = None
+# Adds drawing tools to the map, a drawn polygon is reduced over its whole area (cloud.query_area) instead of
+# sampling one point. Needs the Earth Engine backend.
+area_queries = False
+# Stage timings: shown in an expander under the results, served in Prometheus format on metrics_port, logged per call.
+show_metrics_panel = False
+metrics_port = None
+log_metrics = False
 
 def main():
     # Config for website
@@ -30,86 +77,61 @@ def main():
         unsafe_allow_html=True,
         )
     
-    @st.cache
-    def load_profiles():
-        p = open('profiles.json')
-        profiles = json.load(p)
-        return profiles 
-    @st.cache
-    def load_sand():
-        sand = get_data("sand")
-        return sand
-    @st.cache
-    def load_clay():
-        clay = get_data("clay")
-        return clay
-    @st.cache
-    def load_orgc():
-        orgc = get_data("orgc")
-        return orgc
-
-    profiles = load_profiles()
+    @st.experimental_singleton
+    def load_catalogue():
+        return ProfileCatalogue.load('profiles.json')
+
+    @st.experimental_singleton
+    def load_backend():
+        if os.path.isdir(local_raster_path):
+            return LocalRasterBackend.open(local_raster_path)
+        return EarthEngineBackend()
+
+    @st.experimental_singleton
+    def load_point_cache():
+        return make_point_cache(point_cache_path, version=dataset_version)
+
+    @st.experimental_singleton
+    def load_similarity_raster():
+        if not os.path.exists(os.path.join(similarity_raster_path, 'manifest.json')):
+            return None
+        raster = SimilarityRaster(similarity_raster_path)
+        # A raster scored against an older profiles.json would give stale answers.
+        if not raster.is_current(load_catalogue().profiles_hash):
+            return None
+        return raster
+
+    @st.experimental_singleton
+    def load_job_runner():
+        return JobRunner()
+
+    @st.experimental_singleton
+    def load_tile_renderer():
+        renderer = TileRenderer(raster=load_similarity_raster())
+        if tiles_port is not None:
+            serve_tiles(tiles_port, renderer, tiles_host)
+        return renderer
+
+    @st.experimental_singleton
+    def start_metrics():
+        if metrics_port is not None:
+            serve_prometheus(metrics_port)
+        if log_metrics:
+            metrics.add_sink(LogSink())
+        return True
+
+    start_metrics()
+    catalogue = load_catalogue()
     # Sidebar
     with st.sidebar:
-        # Load profiles as python dict.
-
         st.header('Profiles currently in our database')
         st.subheader('Click through them to learn about the region')
 
         # Lets me programatically build the sidebar based on data in profiles.
-        france_options = []
-        usa_options = []
-        italy_options = []
-        nz_options = []
-        for obj in profiles['profiles']:
-            if obj['properties']['country'] == 'France':
-                france_options.append(obj['properties']['region'])
-            elif obj['properties']['country'] == 'Italy':
-                italy_options.append(obj['properties']['region'])
-            elif obj['properties']['country'] == 'USA':
-                usa_options.append(obj['properties']['region'])
-            elif obj['properties']['country'] == 'New Zealand':
-                nz_options.append(obj['properties']['region'])            
-
-
-
-        country = st.selectbox(label = 'Country', label_visibility='collapsed',options=('France', 'Italy', 'USA','New Zealand'))
-        if country == 'France':
-            region = st.radio(label='Region', options=france_options)
-            # Grab the profile associated with the queried region to build the data card.
-            queried_region_profile = {}
-            for obj in profiles['profiles']:
-                if obj['properties']['region'] == region:
-                    queried_region_profile.update(obj)
-            make_profile_card(queried_region_profile)
-
-        if country == 'Italy':
-            region = st.radio(label='Region', options=italy_options)
-            # Grab the profile associated with the queried region to build the card.
-            queried_region_profile = {}
-            for obj in profiles['profiles']:
-                if obj['properties']['region'] == region:
-                    queried_region_profile.update(obj)
-            make_profile_card(queried_region_profile)
-
-        if country == 'USA':
-            region = st.radio(label='Region', options=usa_options)
-            # Grab the profile associated with the queried region to build the card.
-            queried_region_profile = {}
-            for obj in profiles['profiles']:
-                if obj['properties']['region'] == region:
-                    queried_region_profile.update(obj)
-            
-            make_profile_card(queried_region_profile)
-        
-        if country == 'New Zealand':
-            region = st.radio(label='Region', options=nz_options)
-            # Grab the profile associated with the queried region to build the card.
-            queried_region_profile = {}
-            for obj in profiles['profiles']:
-                if obj['properties']['region'] == region:
-                    queried_region_profile.update(obj)
-            make_profile_card(queried_region_profile)
+        country = st.selectbox(label = 'Country', label_visibility='collapsed',options=catalogue.countries)
+        region = st.radio(label='Region', options=catalogue.regions_in(country))
+        # Grab the profile associated with the queried region to build the data card.
+        make_profile_card(catalogue.region(region), catalogue.display[region])
         
         
 
@@ -320,8 +342,17 @@ def comparison(queried_profile, profiles):
         \nHere is the [GitHub repo](https://github.com/SpencerMartel/VineyardComparison) for this project.""")
     with tab1:
         # Display map
-        my_map = map_creater(None)
-        map_data = stf.st_folium(my_map, width = 1500)
+        raster = load_similarity_raster()
+        overlay = None
+        if raster is not None and st.checkbox('Show the most similar region across Canada'):
+            overlay = raster.overlay()
+        layers = None
+        if show_tile_layers:
+            base_url = (tiles_url or f'http://localhost:{tiles_port}') if tiles_port is not None else None
+            layers = layer_urls(load_tile_renderer(), base_url)
+        with metrics.timer('map'):
+            my_map = map_creater(None, overlay, layers, draw=area_queries)
+            map_data = stf.st_folium(my_map, width = 1500)
 
         
 
@@ -329,63 +360,270 @@ def comparison(queried_profile, profiles):
         clicked_lat_lng = (map_data["last_clicked"])
 
 
-        if not clicked_lat_lng:
+        drawn = drawn_polygon(map_data) if area_queries else None
+        if drawn is not None:
+            show_area(load_backend(), drawn, catalogue)
+        elif not clicked_lat_lng:
             st.subheader('Click anywhere in Canada to load data for that point!')
         else:
             clicked_lat, clicked_lng = round(map_data["last_clicked"]['lat'], 2), round(map_data["last_clicked"]['lng'], 2)
 
-            # Data analysis
-            queried_clay_profile = local_profile(load_clay(), (clicked_lng,clicked_lat), 1000)
-            queried_sand_profile = local_profile(load_sand(), (clicked_lng,clicked_lat), 1000)
-            queried_orgc_profile = local_profile(load_orgc(), (clicked_lng,clicked_lat), 1000)
-
             # Mapping tab (actual app)
             try:
-                df = queried_df(queried_sand_profile, queried_clay_profile, queried_orgc_profile)
-                location_soil_mean_df = calculate_soil_mean(df.T)
-                
-                elevation = get_elevation(clicked_lat, clicked_lng)
-                elevation_result = elevation['altitude']
-
-                location_dict = make_queried_json(location_soil_mean_df, elevation_result, clicked_lat, clicked_lng)
+                click_start = time.perf_counter()
+                cancel_stale_job(clicked_lat, clicked_lng)
+                point_cache = load_point_cache()
+                location_dict = None
+                raster_hit = raster.lookup(clicked_lat, clicked_lng) if raster is not None else None
+                if raster_hit is not None:
+                    location_dict = raster_hit[0]
+                if location_dict is None:
+                    location_dict = point_cache.get(clicked_lat, clicked_lng)
+                if location_dict is None:
+                    if query_mode == 'async':
+                        location_dict, message = show_progress(click_job(load_job_runner(), load_backend(), clicked_lat, clicked_lng))
+                    elif query_mode == 'service':
+                        location_dict, message = query_service(clicked_lat, clicked_lng)
+                    else:
+                        location_dict, message = query_location(load_backend(), clicked_lat, clicked_lng)
+                    if message:
+                        st.subheader(message)
+                        return
+                    point_cache.set(clicked_lat, clicked_lng, location_dict)
                 try:
-                    closest_region_string, all_scores = comparison(location_dict, profiles)
+                    ranked_regions = closest_regions(location_dict, catalogue.reference, k=4)
+                    closest_region_string = ranked_regions[0]["region"]
                 except TypeError:
                     st.subheader('No data for that location, make sure to click in Canada and not on a body of water.')
                     return
                 
-                for region in profiles["profiles"]:
-                    if region["properties"]["region"] == closest_region_string:
-                        closest_region_dict = region
-
-                st.markdown(f'<div style="text-align: center;font-weight: bold;font-size: 25px;">Most Similar Region</div>', unsafe_allow_html=True)
-                st.markdown(f'<div style="text-align: center;font-weight: bold;font-size: 35px;"><u>{closest_region_dict["properties"]["region"]} - {closest_region_dict["properties"]["country"]}</u></div>', unsafe_allow_html=True)
-                st.write('')
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric('Elevation', f'{location_dict["mean_elevation"]} m', delta = f'{round(location_dict["mean_elevation"] - closest_region_dict["properties"]["mean_elevation"],2 )} m')
-                with col2:
-                    st.metric('Average Temperature', f'{location_dict["mean_temp"]} °C', delta = f'{round(location_dict["mean_temp"] - closest_region_dict["properties"]["mean_temp"],2)} °C')
-                with col3:
-                    st.metric('Diurnal Range', f'{location_dict["avg_diurnal_range"]} °C', delta = f'{round(location_dict["avg_diurnal_range"] - closest_region_dict["properties"]["avg_diurnal_range"],2)} °C')
-                with col1:
-                    st.metric('Organic Matter in Soil', f'{location_dict["mean_soil_content_%"]["Organic Matter"]} %', delta = f'{round(location_dict["mean_soil_content_%"]["Organic Matter"] - closest_region_dict["properties"]["mean_soil_content_%"]["Organic Matter"],2)} %')
-                with col2:
-                    st.metric('Clay in Soil', f'{location_dict["mean_soil_content_%"]["Clay"]} %', delta = f'{round(location_dict["mean_soil_content_%"]["Clay"] - closest_region_dict["properties"]["mean_soil_content_%"]["Clay"],2)} %')
-                with col3:
-                    st.metric('Sand in Soil', f'{location_dict["mean_soil_content_%"]["Sand"]} %', delta = f'{round(location_dict["mean_soil_content_%"]["Sand"] - closest_region_dict["properties"]["mean_soil_content_%"]["Sand"],2)} %')
-                
-                red_grapes = ', '.join(str(p) for p in closest_region_dict['properties']['red_grapes'])
-                white_grapes = ', '.join(str(p) for p in closest_region_dict['properties']['white_grapes'])
-                st.subheader(f'According to this analysis you should try growing {red_grapes}, {white_grapes}.')
-                st.write("These metrics show the data for your selected location, the smaller numbers in red and green show the difference between the location's values and those of the most similar region.")
+                closest_region_dict = catalogue.region(closest_region_string)
+                metrics.observe('click_data', time.perf_counter() - click_start)
+
+                with metrics.timer('render'):
+                    show_result(location_dict, closest_region_dict, catalogue.display[closest_region_string])
+                    show_runners_up(ranked_regions[1:], catalogue)
             except KeyError:
                 st.subheader('No data for that location, make sure to click in Canada and not on a body of water.')
 
-def map_creater(marker_location):
+        if show_metrics_panel:
+            with st.expander('Timings'):
+                rows, counters = metrics.summary()
+                st.table(rows)
+                st.write(counters)
+
+def show_result(location_dict, closest_region_dict, display):
+    """
+    Writes the most similar region and the location's metrics compared to it.
+    """
+    st.markdown(f'<div style="text-align: center;font-weight: bold;font-size: 25px;">Most Similar Region</div>', unsafe_allow_html=True)
+    st.markdown(f'<div style="text-align: center;font-weight: bold;font-size: 35px;"><u>{closest_region_dict["properties"]["region"]} - {closest_region_dict["properties"]["country"]}</u></div>', unsafe_allow_html=True)
+    st.write('')
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric('Elevation', f'{location_dict["mean_elevation"]} m', delta = f'{round(location_dict["mean_elevation"] - closest_region_dict["properties"]["mean_elevation"],2 )} m')
+    with col2:
+        st.metric('Average Temperature', f'{location_dict["mean_temp"]} °C', delta = f'{round(location_dict["mean_temp"] - closest_region_dict["properties"]["mean_temp"],2)} °C')
+    with col3:
+        st.metric('Diurnal Range', f'{location_dict["avg_diurnal_range"]} °C', delta = f'{round(location_dict["avg_diurnal_range"] - closest_region_dict["properties"]["avg_diurnal_range"],2)} °C')
+    with col1:
+        st.metric('Organic Matter in Soil', f'{location_dict["mean_soil_content_%"]["Organic Matter"]} %', delta = f'{round(location_dict["mean_soil_content_%"]["Organic Matter"] - closest_region_dict["properties"]["mean_soil_content_%"]["Organic Matter"],2)} %')
+    with col2:
+        st.metric('Clay in Soil', f'{location_dict["mean_soil_content_%"]["Clay"]} %', delta = f'{round(location_dict["mean_soil_content_%"]["Clay"] - closest_region_dict["properties"]["mean_soil_content_%"]["Clay"],2)} %')
+    with col3:
+        st.metric('Sand in Soil', f'{location_dict["mean_soil_content_%"]["Sand"]} %', delta = f'{round(location_dict["mean_soil_content_%"]["Sand"] - closest_region_dict["properties"]["mean_soil_content_%"]["Sand"],2)} %')
+    
+    red_grapes = display['red_grapes']
+    white_grapes = display['white_grapes']
+    st.subheader(f'According to this analysis you should try growing {red_grapes}, {white_grapes}.')
+    st.write("These metrics show the data for your selected location, the smaller numbers in red and green show the difference between the location's values and those of the most similar region.")
+
+def show_runners_up(ranked_regions, catalogue):
+    """
+    Table of the next most similar regions and how much each feature added to their score (lower is closer).
+    """
+    st.write('')
+    st.subheader('Runners-up')
+    reference = catalogue.reference
+    scored = [feature for feature, weight in zip(features, reference.weights) if weight or reference.metric == "mahalanobis"]
+    rows = []
+    for ranked in ranked_regions:
+        row = {"Region": f'{ranked["region"]} - {catalogue.region(ranked["region"])["properties"]["country"]}', "Score": ranked["score"]}
+        # Features with no weight (diurnal range) add nothing to the score, so they get no column.
+        row.update({feature: value for feature, value in ranked["contributions"].items() if feature in scored})
+        rows.append(row)
+    st.table(rows)
+
+def cancel_stale_job(clicked_lat, clicked_lng):
+    """
+    Cancels the session's background lookups (query_mode "async") when they are for a location that is no longer the clicked one.
+    """
+    job = st.session_state.get('point_job')
+    if job is not None and not job.matches(clicked_lat, clicked_lng):
+        job.cancel()
+        del st.session_state['point_job']
+
+def click_job(runner, backend, clicked_lat, clicked_lng):
+    """
+    The session's background lookups for the clicked location, reruns for the same click pick up the running job.
+    """
+    cancel_stale_job(clicked_lat, clicked_lng)
+    if 'point_job' not in st.session_state:
+        st.session_state['point_job'] = runner.submit(backend, clicked_lat, clicked_lng)
+    return st.session_state['point_job']
+
+def show_progress(job, timeout=10):
+    """
+    Placeholder metrics for the clicked location that are filled in as each of job's lookups finishes.
+    Returns (location_dict, message) like query_location, the placeholders are cleared once everything is back.
+    """
+    progress = st.empty()
+    with progress.container():
+        status = st.empty()
+        col1, col2, col3 = st.columns(3)
+        slots = {
+            "elevation": (col1.empty(), 'Elevation', 'm'),
+            "mean_temp": (col2.empty(), 'Average Temperature', '°C'),
+            "avg_diurnal_range": (col3.empty(), 'Diurnal Range', '°C'),
+            "orgc": (col1.empty(), 'Organic Matter in Soil', '%'),
+            "clay": (col2.empty(), 'Clay in Soil', '%'),
+            "sand": (col3.empty(), 'Sand in Soil', '%'),
+        }
+        for slot, label, unit in slots.values():
+            slot.metric(label, '…')
+        for name in job.updates(timeout):
+            status.caption(f'Loading data for this location… {time.perf_counter() - job.started:.1f}s')
+            if name is None:
+                continue
+            slot, label, unit = slots[name]
+            value, error = job.result(name)
+            if error is not None or value is None or isinstance(value, str):
+                slot.metric(label, 'No data')
+            else:
+                if name in ('sand', 'clay', 'orgc'):
+                    # The soil type's own fraction, show_result replaces it with the final percentages.
+                    value = round(float(np.dot([value[band] for band in depth_bands], aggregation_weights[soil_aggregation])) * 100, 2)
+                slot.metric(label, f'{value} {unit}')
+        status.caption('Comparing to the wine regions…')
+    location_dict, errors = job.location()
+    progress.empty()
+    if errors:
+        # Forget the failed job so clicking the same spot again retries it.
+        st.session_state.pop('point_job', None)
+        return None, f'Could not load {", ".join(errors)} for that location, try again in a moment.'
+    return location_dict, None
+
+def query_service(clicked_lat, clicked_lng):
+    """
+    Fetches the clicked location from the scoring service, each session keeps its own connection.
+    Returns (location_dict, None) or (None, message to show) like query_location.
+    """
+    if 'service_client' not in st.session_state:
+        st.session_state['service_client'] = ServiceClient()
+    try:
+        answer = st.session_state['service_client'].query(clicked_lat, clicked_lng)
+    except ServiceError as e:
+        logger.warning(f'scoring service failed: {e}')
+        return None, 'Could not load that location, try again in a moment.'
+    except OSError as e:
+        logger.warning(f'scoring service unreachable: {e!r}')
+        return None, 'The query service is not available right now, try again in a moment.'
+    if answer is None:
+        return None, 'No data for that location, make sure to click in Canada and not on a body of water.'
+    return answer["location"], None
+
+def query_location(backend, clicked_lat, clicked_lng):
+    """
+    Fetches the profile of a clicked location from backend (Earth Engine or local rasters).
+    Returns (location_dict, None) or (None, message to show) when the location couldn't be loaded.
+    """
+    if query_mode == 'concurrent':
+        location_dict, errors = make_queried_json_concurrently(backend, clicked_lat, clicked_lng)
+        if errors:
+            return None, f'Could not load {", ".join(errors)} for that location, try again in a moment.'
+        return location_dict, None
+
+    # Data analysis, soil, temperature, diurnal range and elevation all come back in one request.
+    point = backend.query_point((clicked_lng,clicked_lat), 1000)
+    if point is None:
+        return None, 'No data for that location, make sure to click in Canada and not on a body of water.'
+    return point_profile_json(point, clicked_lat, clicked_lng), None
+
+def drawn_polygon(map_data):
+    """
+    Ring of [lng, lat] vertices of the last polygon drawn on the map, None when there is none.
+    Deleting it with the map's drawing tools goes back to point queries.
+    """
+    polygons = [drawing["geometry"] for drawing in map_data.get("all_drawings") or [] if drawing["geometry"]["type"] == "Polygon"]
+    if not polygons:
+        return None
+    return polygons[-1]["coordinates"][0]
+
+def show_area(backend, coordinates, catalogue):
+    """
+    Zonal statistics of a drawn parcel, scored against the wine regions from its means like a clicked location.
+    """
+    if not hasattr(backend, 'query_area'):
+        st.subheader('Drawn areas need Earth Engine, they can not be queried from the local rasters.')
+        return
+    # Reruns for the same drawing reuse its result.
+    key = json.dumps(coordinates)
+    if st.session_state.get('area_key') != key:
+        with metrics.timer('area_data'):
+            st.session_state['area'] = backend.query_area(coordinates)
+        st.session_state['area_key'] = key
+    area = st.session_state['area']
+    if area is None:
+        st.subheader('No data for that area, make sure to draw it in Canada and not on a body of water.')
+        return
+    location_dict = point_profile_json(area.profile, None, None)
+    ranked_regions = closest_regions(location_dict, catalogue.reference, k=4)
+    closest_region_string = ranked_regions[0]["region"]
+    with metrics.timer('render'):
+        show_result(location_dict, catalogue.region(closest_region_string), catalogue.display[closest_region_string])
+        show_area_stats(area)
+        show_runners_up(ranked_regions[1:], catalogue)
+
+def show_area_stats(area):
+    """
+    Percentiles of every band over the drawn area and the histogram of one of them.
+    """
+    labels = {"sand": 'Sand (%)', "clay": 'Clay (%)', "orgc": 'Organic Matter (%)', "temp": 'Average Temperature (°C)',
+              "diurnal": 'Diurnal Range (°C)', "elevation": 'Elevation (m)'}
+    # Soil fractions are shown as percentages like everywhere else in the app.
+    factors = {"sand": 100, "clay": 100, "orgc": 100}
+    st.write('')
+    st.subheader('Across the area')
+    st.caption(f'Reduced at {area.scale} m per pixel.')
+    rows = []
+    for band, stats in area.stats.items():
+        factor = factors.get(band, 1)
+        row = {"": labels[band]}
+        row.update({name: round(value * factor, 2) for name, value in stats.items() if name != 'histogram'})
+        rows.append(row)
+    st.table(rows)
+    band = st.selectbox('Distribution', options=list(labels), format_func=labels.get)
+    histogram = area.stats[band]["histogram"]
+    factor = factors.get(band, 1)
+    st.bar_chart(pandas.DataFrame({"pixels": histogram["histogram"]}, index=[round(mean * factor, 2) for mean in histogram["bucketMeans"]]))
+
+def map_creater(marker_location, overlay=None, layers=None, draw=False):
     my_map = folium.Map(location=(57.70414723434193, -108.28125000000001), zoom_start = 3, max_bounds=[[-180, -90], [180, 90]], tiles= "openstreetmap")
     if marker_location != None:
         folium.Marker(marker_location).add_to(my_map)
+    if overlay is not None:
+        # overlay is (best region grid, bounds, number of regions) from SimilarityRaster.overlay, one colour per region.
+        best_region, bounds, n_regions = overlay
+        palette = [(0, 0, 0, 0)] + [tuple(int(c * 255) for c in colorsys.hsv_to_rgb(i / max(n_regions, 1), 0.7, 0.9)) + (160,) for i in range(n_regions)]
+        image = np.array(palette, dtype=np.uint8)[best_region + 1]
+        folium.raster_layers.ImageOverlay(image=image, bounds=bounds, origin='upper').add_to(my_map)
+    if layers:
+        # layers is {name: XYZ url} from tiles.layer_urls, toggled from the layer control and hidden to start with.
+        for name, url in layers.items():
+            folium.TileLayer(tiles=url, attr='Google Earth Engine', name=name, overlay=True, show=False, opacity=0.7).add_to(my_map)
+        folium.LayerControl().add_to(my_map)
+    if draw:
+        plugins.Draw(export=False, draw_options={"polyline": False, "circle": False, "marker": False, "circlemarker": False}).add_to(my_map)
     return my_map
 
 if __name__ == '__main__':
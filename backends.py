@@ -0,0 +1,155 @@
+import threading
+import time
+import cloud
+import data_analysis
+import geometry
+from soil import SoilProfile
+
+
+class EarthEngineBackend:
+    """
+    The live point lookups, Earth Engine for soil, temperature and diurnal range and geogratis for elevation.
+    Any object with the first four methods can be passed to data_analysis.fetch_point_concurrently,
+    query_point and sample_points sample every band at once (see cloud.get_point_image),
+    query_area reduces it over a drawn polygon (cloud.query_area).
+    local_raster.LocalRasterBackend implements the point methods from exported rasters.
+    """
+
+    def soil_profile(self, param, poi, buffer):
+        return cloud.local_profile(cloud.get_data(param), poi, buffer)
+
+    def location_temp(self, lat, long):
+        return data_analysis.get_location_temp(lat, long)
+
+    def diurnal_range(self, long, lat):
+        return data_analysis.get_location_diurnal_range(long, lat)
+
+    def elevation(self, lat, long):
+        return data_analysis.get_elevation(lat, long)['altitude']
+
+    def query_point(self, poi, buffer):
+        return cloud.query_point(poi, buffer)
+
+    def sample_points(self, points, buffer):
+        return cloud.sample_points(points, buffer)
+
+    def query_area(self, coordinates):
+        return cloud.query_area(coordinates)
+
+
+class FakeBackend:
+    """
+    Offline stand-in for EarthEngineBackend, returns fixed values after an optional delay.
+    latency is seconds, a dict of {method name: seconds} or a function of the method name returning seconds,
+    so slow, hanging or randomly distributed lookups can be simulated.
+    failures is a dict of {method name: exception} raised instead of returning a value.
+    """
+
+    def __init__(self, soil=None, temp=10.0, diurnal=12.0, elevation=100.0, latency=0, failures=None):
+        self.soil = soil or {
+            "sand": {band: 0.3 for band in cloud.olm_bands},
+            "clay": {band: 0.25 for band in cloud.olm_bands},
+            "orgc": {band: 0.01 for band in cloud.olm_bands},
+        }
+        self.temp = temp
+        self.diurnal = diurnal
+        self.altitude = elevation
+        self.latency = latency
+        self.failures = failures or {}
+        self.calls = 0
+
+    def _call(self, name, value):
+        self.calls += 1
+        if callable(self.latency):
+            delay = self.latency(name)
+        elif isinstance(self.latency, dict):
+            delay = self.latency.get(name, 0)
+        else:
+            delay = self.latency
+        if delay:
+            time.sleep(delay)
+        if name in self.failures:
+            raise self.failures[name]
+        return value
+
+    def soil_profile(self, param, poi, buffer):
+        return self._call("soil_profile", dict(self.soil[param]))
+
+    def location_temp(self, lat, long):
+        return self._call("location_temp", self.temp)
+
+    def diurnal_range(self, long, lat):
+        return self._call("diurnal_range", self.diurnal)
+
+    def elevation(self, lat, long):
+        return self._call("elevation", self.altitude)
+
+    def point_profile(self):
+        soil = SoilProfile.from_bands(self.soil["sand"], self.soil["clay"], self.soil["orgc"], cloud.soil_aggregation)
+        return cloud.PointProfile(soil, self.temp, self.diurnal, self.altitude)
+
+    def query_point(self, poi, buffer):
+        return self._call("query_point", self.point_profile())
+
+    def sample_points(self, points, buffer):
+        return self._call("sample_points", [self.point_profile() for _ in points])
+
+    def query_area(self, coordinates):
+        # Every pixel has the same values, so each histogram is a single bucket.
+        sand, clay, orgc = self.point_profile().soil.aggregates()
+        values = {"sand": sand, "clay": clay, "orgc": orgc, "temp": self.temp, "diurnal": self.diurnal, "elevation": self.altitude}
+        reduced = {}
+        for band, value in values.items():
+            reduced[f'{band}_mean'] = value
+            reduced.update({f'{band}_p{p}': value for p in cloud.area_percentiles})
+            reduced[f'{band}_histogram'] = {"bucketMeans": [value], "bucketMin": value, "bucketWidth": 0, "histogram": [1]}
+        return self._call("query_area", cloud.area_profile(reduced, geometry.reduction_scale(coordinates, cloud.area_max_pixels)))
+
+
+class TooManyRequests(Exception):
+    status_code = 429
+
+
+class ThrottlingBackend(FakeBackend):
+    """
+    FakeBackend that behaves like Earth Engine under load, for exercising ratelimit.limiter.
+    Every lookup is a request sent through cloud.get_info, one that arrives while max_concurrent others are
+    running fails with a 429 like Earth Engine's. throttled counts those, peak the most requests ever running at once.
+    Takes the same arguments as FakeBackend.
+    """
+
+    def __init__(self, max_concurrent=4, **kwargs):
+        super().__init__(**kwargs)
+        self.max_concurrent = max_concurrent
+        self.active = 0
+        self.peak = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def _call(self, name, value):
+        return cloud.get_info(SimulatedRequest(self, name, value))
+
+
+class SimulatedRequest:
+    """
+    Stands in for an ee object, getInfo is one request to ThrottlingBackend's simulated server.
+    """
+
+    def __init__(self, backend, name, value):
+        self.backend = backend
+        self.name = name
+        self.value = value
+
+    def getInfo(self):
+        backend = self.backend
+        with backend.lock:
+            if backend.active >= backend.max_concurrent:
+                backend.throttled += 1
+                raise TooManyRequests('429 Too Many Requests: too many concurrent aggregations')
+            backend.active += 1
+            backend.peak = max(backend.peak, backend.active)
+        try:
+            return FakeBackend._call(backend, self.name, self.value)
+        finally:
+            with backend.lock:
+                backend.active -= 1
@@ -0,0 +1,154 @@
+import argparse
+import csv
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from data_analysis import point_profile_json
+from ratelimit import BATCH, is_retryable, priority
+from scoring import ReferenceMatrix, features, profile_vector
+
+
+def read_points(points):
+    """
+    Accepts a list of (lat, lng) pairs or a DataFrame with lat and lng columns.
+    """
+    if hasattr(points, 'columns'):
+        return list(zip(points['lat'], points['lng']))
+    return [(lat, lng) for lat, lng in points]
+
+
+def sample_with_retry(backend, chunk, buffer, retries, backoff):
+    """
+    Samples one chunk of points, retrying failed requests with jittered exponential backoff.
+    Its Earth Engine requests queue behind interactive ones (ratelimit.BATCH). Throttled and 5xx requests were
+    already retried by ratelimit.limiter, so they are not retried again here.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with priority(BATCH):
+                return backend.sample_points(chunk, buffer)
+        except Exception as e:
+            if attempt == retries or is_retryable(e):
+                raise
+            time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def score_chunk(chunk, points, reference):
+    """
+    Turns a sampled chunk into result rows scored against every region in one vectorized call.
+    """
+    rows = []
+    vectors = []
+    for (lat, lng), point in zip(chunk, points):
+        row = {"lat": lat, "lng": lng}
+        if point is None:
+            row["error"] = "no data"
+        else:
+            location_dict = point_profile_json(point, lat, lng)
+            vectors.append(profile_vector(location_dict))
+            row.update(zip(features, vectors[-1]))
+        rows.append(row)
+
+    if vectors:
+        scores = reference.score(vectors).round(2)
+        scored_rows = (row for row in rows if "error" not in row)
+        for row, region_scores in zip(scored_rows, scores):
+            best = int(region_scores.argmin())
+            row["closest_region"] = reference.regions[best]
+            row["score"] = float(region_scores[best])
+            row.update({f'score_{region}': float(score) for region, score in zip(reference.regions, region_scores)})
+    return rows
+
+
+def score_points(points, reference, backend, chunk_size=500, max_workers=4, retries=3, backoff=2, buffer=1000):
+    """
+    Profiles and scores many locations, yielding one result row per point in input order.
+    Points are sampled chunk_size at a time (one sampleRegions request per chunk) with up to max_workers chunks in flight.
+    A chunk that still fails after retries yields rows with its error instead of stopping the whole run.
+    """
+    points = read_points(points)
+    chunks = [points[i:i + chunk_size] for i in range(0, len(points), chunk_size)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Keep a bounded window of chunks in flight so results stream out instead of piling up in memory.
+        pending = []
+        next_chunk = 0
+        while pending or next_chunk < len(chunks):
+            while next_chunk < len(chunks) and len(pending) < max_workers * 2:
+                chunk = chunks[next_chunk]
+                pending.append((chunk, executor.submit(sample_with_retry, backend, chunk, buffer, retries, backoff)))
+                next_chunk += 1
+            chunk, future = pending.pop(0)
+            try:
+                sampled = future.result()
+            except Exception as e:
+                for lat, lng in chunk:
+                    yield {"lat": lat, "lng": lng, "error": str(e)}
+                continue
+            yield from score_chunk(chunk, sampled, reference)
+
+
+def output_columns(reference):
+    return ["lat", "lng", "closest_region", "score"] + features + \
+        [f'score_{region}' for region in reference.regions] + ["error"]
+
+
+def write_csv(rows, path, reference):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=output_columns(reference))
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+
+def write_parquet(rows, path, reference, batch_rows=10000):
+    # pyarrow is only needed for parquet output.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = output_columns(reference)
+    schema = pa.schema([(c, pa.string() if c in ("closest_region", "error") else pa.float64()) for c in columns])
+    with pq.ParquetWriter(path, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_rows:
+                writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+                batch = []
+        if batch:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score a CSV of candidate sites (lat, lng columns) against the wine region profiles.')
+    parser.add_argument('input')
+    parser.add_argument('output', help='.csv or .parquet')
+    parser.add_argument('--profiles', default='profiles.json')
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--fake', action='store_true', help='use backends.FakeBackend instead of Earth Engine')
+    parser.add_argument('--service', action='store_true', help='send the points to the running scoring service (service.py)')
+    args = parser.parse_args()
+
+    with open(args.profiles) as f:
+        reference = ReferenceMatrix.from_profiles(json.load(f))
+    with open(args.input, newline='') as f:
+        points = [(float(row['lat']), float(row['lng'])) for row in csv.DictReader(f)]
+
+    if args.service:
+        from service import ServiceClient
+        rows = ServiceClient().score_points(points, args.chunk_size)
+    else:
+        from backends import EarthEngineBackend, FakeBackend
+        backend = FakeBackend() if args.fake else EarthEngineBackend()
+        rows = score_points(points, reference, backend, args.chunk_size, args.workers, args.retries)
+    if args.output.endswith('.parquet'):
+        write_parquet(rows, args.output, reference)
+    else:
+        write_csv(rows, args.output, reference)
+
+
+if __name__ == '__main__':
+    main()
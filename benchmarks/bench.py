@@ -0,0 +1,223 @@
+"""
+Benchmarks for the query and scoring pipeline, run against backends.FakeBackend so results don't depend
+on the network. Upstream latency is drawn from seeded lognormal distributions, so every run sees the same delays.
+
+    click       - end-to-end click latency: query_point, point_profile_json, comparison
+    sessions    - clicks per second with N simulated sessions clicking at the same time
+    scoring     - comparison() cost and batched scoring cost as the catalogue grows from 12 to 10k regions
+    build       - make_profile.main() on a copy of profiles.json, a full build and an incremental rebuild
+
+Run from the repo root:
+    python benchmarks/bench.py                    # print results
+    python benchmarks/bench.py --save             # store them as benchmarks/baseline.json
+    python benchmarks/bench.py --compare          # exit 1 if anything is slower than the baseline by --tolerance
+                                                  # (no baseline yet: says so and exits 0)
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+import numpy as np
+from backends import FakeBackend
+from data_analysis import comparison, point_profile_json
+from scoring import ReferenceMatrix, profile_vector
+
+baseline_path = os.path.join(repo_root, 'benchmarks', 'baseline.json')
+profiles_path = os.path.join(repo_root, 'profiles.json')
+
+
+def lognormal_latency(median, sigma=0.5, seed=0):
+    """
+    Returns a latency function for FakeBackend drawing from a seeded lognormal distribution around median seconds.
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def latency(name):
+        with lock:
+            return rng.lognormvariate(np.log(median), sigma)
+    return latency
+
+
+def load_profiles():
+    with open(profiles_path) as f:
+        return json.load(f)
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        "p50_ms": round(1000 * samples[len(samples) // 2], 3),
+        "p95_ms": round(1000 * samples[int(len(samples) * 0.95) - 1], 3),
+        "mean_ms": round(1000 * statistics.mean(samples), 3),
+    }
+
+
+def click(backend, reference, lat, lng):
+    point = backend.query_point((lng, lat), 1000)
+    location_dict = point_profile_json(point, lat, lng)
+    return comparison(location_dict, reference)
+
+
+def bench_click(reference, clicks, median_latency):
+    backend = FakeBackend(latency=lognormal_latency(median_latency))
+    samples = []
+    for i in range(clicks):
+        start = time.perf_counter()
+        click(backend, reference, 45 + i * 0.01, -75)
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def bench_sessions(reference, sessions, clicks_per_session, median_latency):
+    backend = FakeBackend(latency=lognormal_latency(median_latency, seed=1))
+
+    def session(n):
+        for i in range(clicks_per_session):
+            click(backend, reference, 45 + n * 0.1, -75 + i * 0.01)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        list(executor.map(session, range(sessions)))
+    elapsed = time.perf_counter() - start
+    return {"sessions": sessions, "clicks_per_s": round(sessions * clicks_per_session / elapsed, 2)}
+
+
+def synthetic_reference(profiles, size, seed=0):
+    """
+    The real catalogue tiled up to size regions, with seeded noise so regions are distinct.
+    """
+    base = ReferenceMatrix.from_profiles(profiles)
+    rng = np.random.default_rng(seed)
+    rows = base.matrix[np.arange(size) % len(base.regions)]
+    matrix = rows * rng.uniform(0.9, 1.1, rows.shape)
+    return ReferenceMatrix([f'region_{i}' for i in range(size)], matrix)
+
+
+def bench_scoring(profiles, sizes, repeats):
+    location_dict = point_profile_json(FakeBackend().point_profile(), 45, -75)
+    queries = np.tile(profile_vector(location_dict), (1000, 1))
+    results = {}
+    for size in sizes:
+        reference = synthetic_reference(profiles, size)
+        single = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            comparison(location_dict, reference)
+            single.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        reference.score(queries)
+        batch = time.perf_counter() - start
+        results[str(size)] = {"comparison_p50_ms": percentiles(single)["p50_ms"], "batch_1000_ms": round(1000 * batch, 3)}
+    return results
+
+
+def bench_build(median_latency):
+    import make_profile
+
+    latency = lognormal_latency(median_latency, seed=2)
+
+    def fake_compute(coordinates, scale):
+        time.sleep(latency('compute_region'))
+        return {"mean_elevation": 100.0, "mean_temp": 10.0, "avg_diurnal_range": 12.0,
+                "mean_soil_content_%": {"Sand": 30.0, "Clay": 25.0, "Organic Matter": 1.0, "Other": 44.0}}
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'profiles.json')
+        shutil.copy(profiles_path, path)
+        options = dict(path=path, compute=fake_compute, checkpoints=os.path.join(directory, 'checkpoints'),
+                       geometries=os.path.join(directory, 'geometries.json'), compiled=os.path.join(directory, 'catalogue'))
+        # make_profile prints a line per region, kept out of the benchmark's own output.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            make_profile.main(**options)
+            full = time.perf_counter() - start
+            start = time.perf_counter()
+            make_profile.main(**options)
+            incremental = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+    return {"full_s": round(full, 3), "incremental_s": round(incremental, 3)}
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the metrics that got worse than the baseline by more than tolerance (a fraction).
+    Throughput is better when higher, everything else is a duration.
+    """
+    regressions = []
+    current = flatten(results)
+    for name, old in flatten(baseline).items():
+        new = current.get(name)
+        if new is None or not isinstance(old, (int, float)) or old == 0 or name.endswith('sessions'):
+            continue
+        worse = new < old * (1 - tolerance) if name.endswith('clicks_per_s') else new > old * (1 + tolerance)
+        if worse:
+            regressions.append(f'{name}: {old} -> {new}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=0.05, help='median fake upstream latency in seconds')
+    parser.add_argument('--clicks', type=int, default=50)
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[12, 100, 1000, 10000])
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--skip-build', action='store_true')
+    parser.add_argument('--save', action='store_true')
+    parser.add_argument('--compare', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    profiles = load_profiles()
+    reference = ReferenceMatrix.from_profiles(profiles)
+    results = {
+        "click": bench_click(reference, args.clicks, args.latency),
+        "sessions": bench_sessions(reference, args.sessions, args.clicks // 5 or 1, args.latency),
+        "scoring": bench_scoring(profiles, args.sizes, args.repeats),
+    }
+    if not args.skip_build:
+        results["build"] = bench_build(args.latency)
+    print(json.dumps(results, indent = 4))
+
+    if args.save:
+        with open(baseline_path, 'w') as f:
+            f.write(json.dumps(results, indent = 4))
+    if args.compare:
+        # Baselines depend on the machine, so none is committed. Record one with --save first.
+        if not os.path.exists(baseline_path):
+            print(f'No baseline at {baseline_path}, run with --save to record one. Nothing to compare.')
+            return
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressions:\n' + '\n'.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Cold start benchmark for the Streamlit app process.
+
+Measures, in fresh interpreters:
+    import   - time to import app.py (every module and library the first frame pulls in)
+    server   - with --server, time from launching `streamlit run app.py` until its health endpoint answers
+
+Run from the repo root: python benchmarks/cold_start.py --runs 5 --server
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+import_snippet = '''
+import time
+start = time.perf_counter()
+import app
+print(time.perf_counter() - start)
+'''
+
+
+def time_import():
+    result = subprocess.run([sys.executable, '-c', import_snippet], cwd=repo_root, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def time_server(port, timeout=120):
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'streamlit', 'run', 'app.py', '--server.headless', 'true', '--server.port', str(port)],
+        cwd=repo_root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            # The health endpoint moved between streamlit versions.
+            for path in ('/healthz', '/_stcore/health'):
+                try:
+                    with urllib.request.urlopen(f'http://localhost:{port}{path}', timeout=1) as response:
+                        if response.status == 200:
+                            return time.perf_counter() - start
+                except OSError:
+                    pass
+            time.sleep(0.05)
+        raise TimeoutError(f'streamlit did not answer within {timeout}s')
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def summarize(samples):
+    return {"runs": len(samples), "median_s": round(statistics.median(samples), 4),
+            "min_s": round(min(samples), 4), "max_s": round(max(samples), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--server', action='store_true')
+    parser.add_argument('--port', type=int, default=8599)
+    args = parser.parse_args()
+
+    results = {"import": summarize([time_import() for _ in range(args.runs)])}
+    if args.server:
+        results["server"] = summarize([time_server(args.port) for _ in range(args.runs)])
+    print(json.dumps(results, indent = 4))
+
+
+if __name__ == '__main__':
+    main()
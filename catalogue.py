@@ -0,0 +1,93 @@
+import json
+from compiled_catalogue import CompiledCatalogue, compiled_path, profiles_hash
+from data_analysis import make_card_chart
+from scoring import ReferenceMatrix
+
+
+class ProfileCatalogue:
+    """
+    profiles.json indexed once so the app never has to scan the profile list on a rerun.
+        reference  - scoring.ReferenceMatrix, the numeric features as a (regions x features) array
+        by_region  - {region name: profile feature}, without its geometry when loaded from a compiled catalogue
+        by_country - {country: [region names]} in the order they appear in profiles.json
+        display    - {region name: card fields (grape strings, soil table)}, built the first time a region is shown
+    Countries come from the profiles themselves so a new country shows up without touching the app.
+    """
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.profiles_hash = profiles_hash(profiles)
+        self.reference = ReferenceMatrix.from_profiles(profiles)
+        self.compiled = None
+        self._index(profiles["profiles"])
+
+    def _index(self, regions):
+        self.by_region = {}
+        self.by_country = {}
+        self.display = CardFields(self)
+        for region in regions:
+            properties = region["properties"]
+            self.by_region[properties["region"]] = region
+            self.by_country.setdefault(properties["country"], []).append(properties["region"])
+
+    @classmethod
+    def from_compiled(cls, compiled):
+        """
+        From a compiled_catalogue.CompiledCatalogue, the reference matrix is its memory mapped features.
+        """
+        catalogue = cls.__new__(cls)
+        catalogue.profiles = None
+        catalogue.profiles_hash = compiled.profiles_hash
+        catalogue.reference = ReferenceMatrix(compiled.regions, compiled.features)
+        catalogue.compiled = compiled
+        catalogue._index([{"type": "Feature", "properties": properties} for properties in compiled.properties])
+        return catalogue
+
+    @classmethod
+    def load(cls, path='profiles.json', compiled=compiled_path):
+        """
+        Uses the catalogue make_profile.py compiled from path when it is up to date, otherwise parses path.
+        """
+        current = CompiledCatalogue.open_current(path, compiled) if compiled else None
+        if current is not None:
+            return cls.from_compiled(current)
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @property
+    def countries(self):
+        return list(self.by_country)
+
+    def regions_in(self, country):
+        return self.by_country.get(country, [])
+
+    def region(self, name):
+        return self.by_region[name]
+
+    def geometry(self, name):
+        """
+        A region's geometry, read from the compiled geometry file only when asked for.
+        """
+        if self.compiled is None:
+            return self.by_region[name]["geometry"]
+        return self.compiled.geometry(self.compiled.positions[name])
+
+
+class CardFields(dict):
+    """
+    {region name: card fields}, filled in on first access so startup doesn't grow with the number of regions.
+    """
+
+    def __init__(self, catalogue):
+        super().__init__()
+        self.catalogue = catalogue
+
+    def __missing__(self, name):
+        region = self.catalogue.region(name)
+        properties = region["properties"]
+        fields = self[name] = {
+            "red_grapes": ', '.join(str(p) for p in properties['red_grapes']),
+            "white_grapes": ', '.join(str(p) for p in properties['white_grapes']),
+            "soil_table": make_card_chart(region),
+        }
+        return fields
@@ -1,26 +1,175 @@
+import logging
+import threading
+from typing import NamedTuple
 import ee
-import streamlit as st
+import geometry
+from metrics import metrics, timed
+from ratelimit import limiter
+from singleflight import quantize, single_flight
+from soil import SoilProfile, aggregation_weights
 
-service_account = st.secrets["ee_email"]
-service_key = st.secrets["ee_key"]
-credentials = ee.ServiceAccountCredentials(email = service_account, key_data = service_key)
-ee.Initialize(credentials)
+logger = logging.getLogger('vineyard.cloud')
+
+_initialized = False
+_initialize_lock = threading.Lock()
+# The earthengine-api release pinned in requirements.txt, the only one _install_retry_switch knows the internals of.
+ee_api_version = '0.1.326'
+# Set while the calling thread runs a request through limited_call.
+_request_state = threading.local()
+
+
+def initialize():
+    """
+    Starts the Earth Engine session the first time something needs it, once per process.
+    Uses the service account in the streamlit secrets when there is one, otherwise the local
+    earthengine credentials (what make_profile.py used).
+    """
+    global _initialized
+    if _initialized:
+        return
+    with _initialize_lock:
+        if _initialized:
+            return
+        try:
+            import streamlit as st
+            credentials = ee.ServiceAccountCredentials(email = st.secrets["ee_email"], key_data = st.secrets["ee_key"])
+        except (ImportError, FileNotFoundError, KeyError):
+            credentials = None
+        if credentials is None:
+            ee.Initialize()
+        else:
+            ee.Initialize(credentials)
+        _install_retry_switch()
+        _initialized = True
+
+
+def _install_retry_switch():
+    """
+    Turns off the client's own retries (googleapiclient, 5 of them) for requests made through limited_call.
+    ratelimit.limiter retries those and adapts to every 429 it sees, client retries would hide them from it and
+    multiply the attempts. Every other Earth Engine request keeps the client's retries.
+    ee.data._execute_cloud_call is private, so this is only done on the pinned ee_api_version.
+    """
+    execute = getattr(ee.data, '_execute_cloud_call', None)
+    if ee.__version__ != ee_api_version or execute is None:
+        logger.warning(f'earthengine-api {ee.__version__} is not {ee_api_version}, throttled requests are also retried by the client')
+        return
+
+    def execute_cloud_call(call, num_retries=ee.data.MAX_RETRIES):
+        if getattr(_request_state, 'limited', False):
+            num_retries = 0
+        return execute(call, num_retries)
+    ee.data._execute_cloud_call = execute_cloud_call
+
+
+def limited_call(func, *args, **kwargs):
+    """
+    func(*args, **kwargs) making Earth Engine requests, through ratelimit.limiter and without the client's retries.
+    """
+    return limiter.call(_without_client_retries, func, *args, **kwargs)
+
+
+def _without_client_retries(func, *args, **kwargs):
+    _request_state.limited = True
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _request_state.limited = False
+
+
+def get_info(ee_object):
+    """
+    Fetches an Earth Engine object, every round trip goes through here so they are counted and timed.
+    Requests wait their turn in ratelimit.limiter at the calling thread's priority and are retried when throttled.
+    """
+    return limited_call(_get_info, ee_object)
+
+
+def _get_info(ee_object):
+    with metrics.timer('ee_get_info'):
+        return ee_object.getInfo()
 
 
 # Soil depths [in cm] where we have data.
 olm_depths = [0, 10, 30, 60, 100, 200]
 # Names of bands associated with reference depths.
 olm_bands = ["b" + str(sd) for sd in olm_depths]
+# Soil datasets sampled for every queried location.
+soil_params = ["sand", "clay", "orgc"]
+# Summer months averaged for the diurnal range.
+diurnal_months = ['may', 'jun', 'jul', 'aug', 'sep']
+# How the soil depth bands are combined, one of soil.aggregation_weights. Done in Earth Engine by get_point_image.
+soil_aggregation = 'mean'
+# Bump whenever a dataset or scale factor below changes, cached point results are keyed on it.
+dataset_version = f'olm-v02_worldclim-v1_lst-v01_cdem_{soil_aggregation}'
+
+
+class PointProfile(NamedTuple):
+    """
+    Everything a map click needs, as returned by query_point.
+    """
+    soil: SoilProfile
+    mean_temp: float
+    avg_diurnal_range: float
+    elevation: float
+
+# Prebuilt images shared by every session in the process, filled by get_image.
+_images = {}
+_serialized = {}
+_images_lock = threading.RLock()
+
+# Images besides the get_data ones that get_image knows how to build.
+image_builders = {
+    "temp": lambda: ee.Image("WORLDCLIM/V1/BIO").select('bio01').multiply(0.1).rename('temp'),
+    "diurnal_months": lambda: get_data("diurnal").select(diurnal_months),
+    "nasadem": lambda: ee.Image('NASA/NASADEM_HGT/001').select('elevation'),
+    # NRCan/CDEM is published as tiles, mosaic them into one image.
+    "cdem": lambda: ee.ImageCollection('NRCan/CDEM').mosaic().select('elevation'),
+}
+
+
+def get_image(name, build=None):
+    """
+    Returns the image registered under name, building it with build (or image_builders[name]) the first time.
+    ee.Image objects are only client-side expressions, so one instance is safely shared by every session
+    and nothing is rebuilt or re-hashed on a script rerun.
+    """
+    image = _images.get(name)
+    if image is not None:
+        return image
+    with _images_lock:
+        image = _images.get(name)
+        if image is None:
+            initialize()
+            image = (build or image_builders[name])()
+            if image is not None:
+                _images[name] = image
+                _serialized[id(image)] = image.serialize()
+    return image
+
+
+def serialized(image):
+    """
+    Serialized expression of an image, precomputed for registered images.
+    """
+    return _serialized.get(id(image)) or image.serialize()
+
 
 def get_data(param):
     """
-    This function returns soil properties image
+    This function returns soil properties image, built once per process (see get_image)
     param (str): must be one of:
         "sand"     - Sand fraction
         "clay"     - Clay fraction
         "orgc"     - Organic Carbon fraction
         "elev"     - DEM Elevation 
+        "diurnal"  - Monthly diurnal range
     """
+    return get_image(param, lambda: build_data(param))
+
+
+def build_data(param):
+    initialize()
     if param == "sand":  # Sand fraction [%w]
         snippet = "OpenLandMap/SOL/SOL_SAND-WFRACTION_USDA-3A1A1A_M/v02"
         # Define the scale factor in accordance with the dataset description.
@@ -58,9 +207,13 @@ def get_data(param):
     return dataset
 
 
+# Identical datasets serialize identically, so the same soil layer at the same cell shares one request.
+@timed('local_profile')
+@single_flight(lambda dataset, poi, buffer: (serialized(dataset), quantize(poi[1], poi[0]), buffer))
 def local_profile(dataset, poi, buffer):
+    initialize()
     poi=ee.Geometry.Point(poi[0],poi[1])
-    prop = dataset.sample(poi, buffer).select(olm_bands).getInfo()
+    prop = get_info(dataset.sample(poi, buffer).select(olm_bands))
 
     if prop['features'] != []:
         # Selection of the features/properties of interest.
@@ -71,3 +224,144 @@ def local_profile(dataset, poi, buffer):
     else:
         return 'No data :('
 
+
+def dem_elevation(lat, long):
+    """
+    Elevation at a location from the NRCan CDEM in Earth Engine, None over water or outside Canada.
+    """
+    initialize()
+    point = ee.Geometry.Point(long, lat)
+    value = get_info(get_image("cdem").reduceRegion(
+        reducer=ee.Reducer.first(),
+        geometry=point,
+        scale=30,
+    ).get('elevation'))
+    return None if value is None else round(value, 2)
+
+
+def aggregate_soil(dataset, aggregation=None):
+    """
+    Combines the depth bands of a soil image into one band with a single weighted-sum expression,
+    so a sample or reduceRegion returns one value per soil type instead of six.
+    """
+    aggregation = aggregation or soil_aggregation
+    if aggregation == 'mean':
+        return dataset.select(olm_bands).reduce(ee.Reducer.mean())
+    weights = aggregation_weights[aggregation]
+    return dataset.select(olm_bands).multiply(ee.Image.constant(weights)).reduce(ee.Reducer.sum())
+
+
+def get_point_image(aggregation=None):
+    """
+    Returns a single ee.Image with every band a queried location needs so it can be sampled in one request.
+    Bands are sand, clay and orgc aggregated over depth (aggregate_soil), then temp, diurnal and elevation.
+    """
+    aggregation = aggregation or soil_aggregation
+
+    def build():
+        soil = [aggregate_soil(get_data(param), aggregation).rename(param) for param in soil_params]
+        diurnal = get_image("diurnal_months").reduce(ee.Reducer.mean()).rename('diurnal')
+        return ee.Image.cat(soil + [get_image("temp"), diurnal, get_image("cdem")])
+    return get_image(f'point_{aggregation}', build)
+
+
+def point_profile(values):
+    """
+    Builds a PointProfile from the properties of one feature sampled from get_point_image.
+    Also accepts per-depth bands (sand_b0 ... orgc_b200), those are aggregated client side.
+    """
+    if 'sand' in values:
+        soil = SoilProfile.from_aggregates(values['sand'], values['clay'], values['orgc'], soil_aggregation)
+    else:
+        bands = [{band: round(values[f'{param}_{band}'], 5) for band in olm_bands} for param in soil_params]
+        soil = SoilProfile.from_bands(*bands, aggregation=soil_aggregation)
+    return PointProfile(
+        soil = soil,
+        mean_temp = round(values['temp'], 2),
+        avg_diurnal_range = round(values['diurnal'], 2),
+        elevation = round(values['elevation'], 2),
+    )
+
+
+@timed('query_point')
+@single_flight(lambda poi, buffer: (quantize(poi[1], poi[0]), buffer))
+def query_point(poi, buffer):
+    """
+    Samples get_point_image once at poi (lng, lat) and returns a PointProfile.
+    Returns None when there is no data at that location (water, outside Canada).
+    """
+    initialize()
+    point = ee.Geometry.Point(poi[0], poi[1])
+    prop = get_info(get_point_image().sample(point, buffer))
+
+    if prop['features'] == []:
+        return None
+    return point_profile(prop["features"][0]["properties"])
+
+
+def sample_points(points, buffer):
+    """
+    Samples get_point_image at every (lat, lng) in points with one sampleRegions request.
+    Returns a list of PointProfile in the same order, None where there is no data.
+    """
+    initialize()
+    collection = ee.FeatureCollection([
+        ee.Feature(ee.Geometry.Point(lng, lat), {'point_id': i}) for i, (lat, lng) in enumerate(points)])
+    prop = get_info(get_point_image().sampleRegions(
+        collection=collection, properties=['point_id'], scale=buffer, geometries=False))
+
+    profiles = [None] * len(points)
+    for feature in prop['features']:
+        profiles[int(feature['properties']['point_id'])] = point_profile(feature['properties'])
+    return profiles
+
+
+# Statistics of an area query besides the mean, and how many pixels it may reduce per band.
+# Larger parcels are reduced at a coarser scale (geometry.reduction_scale) to stay under area_max_pixels.
+area_percentiles = [10, 50, 90]
+area_histogram_buckets = 20
+area_max_pixels = 1e6
+area_bands = soil_params + ['temp', 'diurnal', 'elevation']
+
+
+class AreaProfile(NamedTuple):
+    profile: PointProfile
+    stats: dict
+    scale: int
+
+
+@timed('query_area')
+def query_area(coordinates, max_pixels=area_max_pixels):
+    """
+    Zonal statistics of get_point_image over a polygon, coordinates is its ring of [lng, lat] vertices.
+    Mean, percentiles and histogram of every band come back from a single reduceRegion.
+    Returns an AreaProfile, its profile holds the means so it is scored like a clicked point,
+    stats is {band: {"mean", "p10", "p50", "p90", "histogram"}}. None when the polygon has no data.
+    """
+    initialize()
+    scale = geometry.reduction_scale(coordinates, max_pixels)
+    reducer = ee.Reducer.mean().combine(
+        ee.Reducer.percentile(area_percentiles), sharedInputs=True).combine(
+        ee.Reducer.histogram(maxBuckets=area_histogram_buckets), sharedInputs=True)
+    values = get_info(get_point_image().reduceRegion(
+        reducer=reducer,
+        geometry=ee.Geometry.Polygon([coordinates]),
+        scale=scale,
+        maxPixels=max_pixels,
+        bestEffort=True,
+    ))
+    return area_profile(values, scale)
+
+
+def area_profile(values, scale):
+    """
+    Builds an AreaProfile from the output of query_area's reduceRegion.
+    """
+    if any(values.get(f'{band}_mean') is None for band in area_bands):
+        return None
+    stats = {}
+    for band in area_bands:
+        stats[band] = {"mean": values[f'{band}_mean']}
+        stats[band].update({f'p{p}': values[f'{band}_p{p}'] for p in area_percentiles})
+        stats[band]["histogram"] = values[f'{band}_histogram']
+    return AreaProfile(point_profile({band: values[f'{band}_mean'] for band in area_bands}), stats, scale)
@@ -0,0 +1,113 @@
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
+from scoring import features, profile_vector
+
+# Written by make_profile.py next to profiles.json, read by catalogue.ProfileCatalogue.load.
+compiled_path = 'catalogue'
+format_version = 1
+
+
+def profiles_hash(profiles):
+    """
+    Content hash of a parsed profiles.json, what similarity_raster builds are checked against.
+    """
+    return hashlib.sha256(json.dumps(profiles, sort_keys=True).encode()).hexdigest()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write(profiles, out_dir=compiled_path, source_path='profiles.json'):
+    """
+    Compiles profiles into three files so loading the catalogue doesn't parse the polygons:
+        features.npy   - (regions x scoring.features) float64, memory mapped by CompiledCatalogue
+        metadata.json  - the region properties (grapes, soil content, ...) and the byte range of each geometry
+        geometries.bin - every region's geometry as JSON, back to back, read only when one is asked for
+    source_path's hash is stored so a catalogue compiled from an older profiles.json is ignored.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    regions = profiles["profiles"]
+    matrix = np.array([profile_vector(region["properties"]) for region in regions], dtype=np.float64).reshape(len(regions), len(features))
+
+    offsets = []
+    with open(os.path.join(out_dir, 'geometries.bin.tmp'), 'wb') as f:
+        for region in regions:
+            blob = json.dumps(region["geometry"]).encode()
+            offsets.append([f.tell(), len(blob)])
+            f.write(blob)
+    np.save(os.path.join(out_dir, 'features.tmp.npy'), matrix)
+    metadata = {
+        "version": format_version,
+        "source_hash": file_hash(source_path),
+        "profiles_hash": profiles_hash(profiles),
+        "features": features,
+        "regions": [region["properties"] for region in regions],
+        "geometry_offsets": offsets,
+    }
+    with open(os.path.join(out_dir, 'metadata.json.tmp'), 'w') as f:
+        f.write(json.dumps(metadata))
+    # metadata.json goes last, it is what marks the catalogue as complete.
+    os.replace(os.path.join(out_dir, 'geometries.bin.tmp'), os.path.join(out_dir, 'geometries.bin'))
+    os.replace(os.path.join(out_dir, 'features.tmp.npy'), os.path.join(out_dir, 'features.npy'))
+    os.replace(os.path.join(out_dir, 'metadata.json.tmp'), os.path.join(out_dir, 'metadata.json'))
+
+
+class CompiledCatalogue:
+    """
+    Read-only view of a compiled catalogue, features are memory mapped and geometries read one at a time.
+    """
+
+    def __init__(self, out_dir=compiled_path):
+        self.out_dir = out_dir
+        with open(os.path.join(out_dir, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        self.properties = self.metadata["regions"]
+        self.regions = [properties["region"] for properties in self.properties]
+        # {region name: row}, so looking a region up doesn't scan the list.
+        self.positions = {region: i for i, region in enumerate(self.regions)}
+        self.features = np.load(os.path.join(out_dir, 'features.npy'), mmap_mode='r')
+
+    @classmethod
+    def open_current(cls, source_path='profiles.json', out_dir=compiled_path):
+        """
+        The compiled catalogue when it exists and was compiled from source_path as it is now, otherwise None.
+        """
+        if not os.path.exists(os.path.join(out_dir, 'metadata.json')):
+            return None
+        compiled = cls(out_dir)
+        if compiled.metadata["version"] != format_version or compiled.metadata["features"] != features:
+            return None
+        if compiled.metadata["source_hash"] != file_hash(source_path):
+            return None
+        return compiled
+
+    @property
+    def profiles_hash(self):
+        return self.metadata["profiles_hash"]
+
+    def geometry(self, index):
+        start, length = self.metadata["geometry_offsets"][index]
+        with open(os.path.join(self.out_dir, 'geometries.bin'), 'rb') as f:
+            f.seek(start)
+            return json.loads(f.read(length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile profiles.json into the binary catalogue the app loads.')
+    parser.add_argument('--profiles', default='profiles.json')
+    parser.add_argument('--out', default=compiled_path)
+    args = parser.parse_args()
+    with open(args.profiles) as f:
+        write(json.load(f), args.out, args.profiles)
+
+
+if __name__ == '__main__':
+    main()
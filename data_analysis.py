@@ -1,19 +1,20 @@
-import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 import ee
-import numpy as np
-import pandas
-import plotly.express as px
-import requests
-import streamlit as st
-import matplotlib as mpl
-from matplotlib import pyplot as plt
+from cloud import get_image, get_info, initialize, soil_aggregation
+from metrics import metrics, timed
+from singleflight import quantize, single_flight
+from scoring import ReferenceMatrix, features, profile_vector
+from soil import SoilProfile
 
-service_account = st.secrets["ee_email"]
-credentials = ee.ServiceAccountCredentials(email = service_account, key_data = st.secrets["ee_key"])
-ee.Initialize(credentials)
+logger = logging.getLogger('vineyard.data_analysis')
 
 
+@timed('queried_df')
 def queried_df (sand_profile, clay_profile, orgc_profile):
+    # pandas, numpy and streamlit are imported where they are used so importing this module stays cheap.
+    import pandas
     data = [sand_profile,clay_profile, orgc_profile]
     df = pandas.DataFrame(data=data)
     df.index = ['Sand', 'Clay', 'Organic Matter']
@@ -21,7 +22,9 @@ def queried_df (sand_profile, clay_profile, orgc_profile):
     df.columns = ['Surface', '10cm', '20cm', '60cm', '100cm', '200cm']
     return df
 
+@timed('calculate_soil_mean')
 def calculate_soil_mean(dataframe):
+    import pandas
 
     sand_mean = round(dataframe['Sand'].mean(), 3)
     clay_mean = round(dataframe['Clay'].mean(), 3)
@@ -33,6 +36,8 @@ def calculate_soil_mean(dataframe):
     return df
     
 def piechart(dataframe):
+    # plotly is only imported when a chart is actually drawn.
+    import plotly.express as px
     df = calculate_soil_mean(dataframe)
 
     fig = px.pie(df, values=df['Mean'], names = df.index, hover_name=df.index)
@@ -40,22 +45,57 @@ def piechart(dataframe):
     return fig
 
 
-def get_elevation(lat,long):
-    url = f'http://geogratis.gc.ca/services/elevation/cdem/altitude?lat={lat}&lon={long}'
-    result = requests.get(url)
-    dict = json.loads(result.text)
-    return dict
+# The CDEM altitude endpoint get_elevation queries.
+geogratis_url = 'http://geogratis.gc.ca/services/elevation/cdem/altitude'
 
-def make_profile_card(region_dict):
+
+@timed('get_elevation')
+@single_flight(lambda lat, long, fallback=None: quantize(lat, long))
+def get_elevation(lat, long, fallback=None):
+    """
+    Elevation from the geogratis CDEM service as {"altitude": metres}.
+    Uses a shared keep-alive session with timeouts and retries. When the service fails or its circuit
+    is open, fallback(lat, long) is used instead, the Earth Engine CDEM (cloud.dem_elevation) by default.
+    """
+    if fallback is None:
+        from cloud import dem_elevation as fallback
+    try:
+        return geogratis_client().get_json(f'{geogratis_url}?lat={lat}&lon={long}')
+    except Exception as e:
+        logger.warning(f'geogratis elevation failed ({e!r}), falling back')
+        metrics.increment('elevation_fallbacks')
+        return {"altitude": fallback(lat, long)}
+
+_geogratis_client = None
+
+def geogratis_client():
+    # Created on first use so requests is only imported when elevation is actually fetched.
+    global _geogratis_client
+    if _geogratis_client is None:
+        from http_client import JsonClient
+        _geogratis_client = JsonClient()
+    return _geogratis_client
+
+def make_profile_card(region_dict, display=None):
+    """
+    display is the region's precomputed fields from catalogue.ProfileCatalogue, built here when not given.
+    """
+    if display is None:
+        display = {
+            "red_grapes": ', '.join(str(p) for p in region_dict['properties']['red_grapes']),
+            "white_grapes": ', '.join(str(p) for p in region_dict['properties']['white_grapes']),
+            "soil_table": make_card_chart(region_dict),
+        }
     # Extract values
     region = region_dict['properties']['region']
     country = region_dict['properties']['country']
-    red_grapes = ', '.join(str(p) for p in region_dict['properties']['red_grapes'])
-    white_grapes = ', '.join(str(p) for p in region_dict['properties']['white_grapes'])
+    red_grapes = display['red_grapes']
+    white_grapes = display['white_grapes']
     elevation = region_dict['properties']['mean_elevation']
     diurnal_range = region_dict['properties']['avg_diurnal_range']
 
     # Write em to screen, no need to return st.container() writes already
+    import streamlit as st
     with st.container():
         st.write('#')
         st.markdown(f'<div style="text-align: center;font-weight: bold;font-size: 22px;">{region}, {country}</div>', unsafe_allow_html=True)
@@ -66,65 +106,92 @@ def make_profile_card(region_dict):
         st.write(f'**Mean elevation:**    {elevation} m')
         st.write(f'**Mean diurnal Range:**    {diurnal_range}°C')
         st.write(f'**Soil Content:**')
-        st.write(make_card_chart(region_dict).style.format("{:.4}%"))
+        st.write(display['soil_table'].style.format("{:.4}%"))
         st.write('##')
 
 
 def make_card_chart (region_dict):
-    
+    import pandas
     df = pandas.DataFrame(data = [region_dict["properties"]["mean_soil_content_%"]], index = ["Mean"])
     df.columns = df.columns.str.capitalize()
     df = df.T
 
     return df
 
+@timed('comparison')
 def comparison(queried_profile, profiles):
-
-    comparative_profiles = make_profile_comparative_json(profiles)
-    closest_profile = ''
-    lowest_score = 1000000
-    list_of_dicts = []
-
-    for comparative_region in comparative_profiles:
-        # Loop through regions, compare values of clicked location to region
-        # Whichever one has the lowest score is the most similar
-        elev = abs(queried_profile["mean_elevation"] - comparative_region["mean_elevation"]) * 0.02
-        temp = abs(queried_profile["mean_temp"] - comparative_region["mean_temp"])
-        clay = abs(queried_profile["mean_soil_content_%"]["Clay"] - comparative_region["mean_soil_content_%"]["Clay"])
-        org = abs(queried_profile["mean_soil_content_%"]["Organic Matter"] - comparative_region["mean_soil_content_%"]["Organic Matter"])
-        other = abs(queried_profile["mean_soil_content_%"]["Other"] - comparative_region["mean_soil_content_%"]["Other"])
-        sand = abs(queried_profile["mean_soil_content_%"]["Sand"] - comparative_region["mean_soil_content_%"]["Sand"])
-        score = round(elev + temp + clay + org + other + sand, 2)
-        
-        if score < lowest_score:
-            lowest_score = score
-            closest_profile = comparative_region["region"]
-
-        comparative_dict = {"region": comparative_region["region"], "score": score}
-        list_of_dicts.append(comparative_dict)
+    """
+    Scores the queried location against every region, lowest score is the most similar.
+    profiles is either the loaded profiles.json dict or a prebuilt scoring.ReferenceMatrix,
+    pass the matrix when comparing repeatedly so it isn't rebuilt on every call.
+    Returns the closest region name and a list of {"region", "score"} dicts in catalogue order.
+    """
+    import numpy as np
+    reference = profiles if isinstance(profiles, ReferenceMatrix) else ReferenceMatrix.from_profiles(profiles)
+    scores = np.round(reference.score(profile_vector(queried_profile))[0], 2)
+    closest_profile = reference.regions[int(np.argmin(scores))]
+    list_of_dicts = [{"region": region, "score": float(score)} for region, score in zip(reference.regions, scores)]
 
     return closest_profile, list_of_dicts
     
 
         
 
-def make_queried_json(soil_df, elevation, lat, long):
-    soil = pandas.DataFrame.to_dict(soil_df)
+@timed('closest_regions')
+def closest_regions(queried_profile, reference, k=3):
+    """
+    The k regions most similar to the queried location, best first, from a scoring.ReferenceMatrix.
+    Each is {"region", "score", "contributions"}, contributions maps each feature to its share of the score.
+    """
+    query = profile_vector(queried_profile)
+    indices, scores = reference.top_k(query, k)
+    contributions = reference.contributions(query, indices[0])
+    results = []
+    for index, score, contribution in zip(indices[0], scores[0], contributions):
+        results.append({
+            "region": reference.regions[index],
+            "score": float(score),
+            "contributions": {feature: round(float(value), 2) for feature, value in zip(features, contribution)},
+        })
+    return results
+
+@timed('make_queried_json')
+def make_queried_json(soil_df, elevation, lat, long, mean_temp=None, diurnal_range=None):
+    """
+    soil_df is either the calculate_soil_mean DataFrame or a soil.SoilProfile.
+    mean_temp and diurnal_range can be passed in when they were already sampled (cloud.query_point),
+    otherwise they are fetched from Earth Engine here.
+    """
+    if isinstance(soil_df, SoilProfile):
+        soil_content = soil_df.percentages()
+    else:
+        soil = soil_df.to_dict()
+        soil_content = {
+            "Clay": round((soil["Mean"]["Clay"] * 100),2),
+            "Organic Matter": round((soil["Mean"]["Organic Matter"] * 100),2),
+            "Other": round((soil["Mean"]["Other"] * 100),2),
+            "Sand": round((soil["Mean"]["Sand"] * 100), 2),
+        }
+    if mean_temp is None:
+        mean_temp = get_location_temp(lat, long)
+    if diurnal_range is None:
+        diurnal_range = get_location_diurnal_range(long, lat)
 
     location_dict = {
             "mean_elevation": elevation,
-            "mean_temp": get_location_temp(lat,long),
-            "mean_soil_content_%" : {
-                "Clay": round((soil["Mean"]["Clay"] * 100),2),
-                "Organic Matter": round((soil["Mean"]["Organic Matter"] * 100),2),
-                "Other": round((soil["Mean"]["Other"] * 100),2),
-                "Sand": round((soil["Mean"]["Sand"] * 100), 2),
-            },
-            "avg_diurnal_range" : get_location_diurnal_range(long, lat),
+            "mean_temp": mean_temp,
+            "mean_soil_content_%" : soil_content,
+            "avg_diurnal_range" : diurnal_range,
         }
     
     return location_dict
 
+def point_profile_json(point, lat, long):
+    """
+    Same output as make_queried_json, from a cloud.PointProfile.
+    """
+    return make_queried_json(point.soil, point.elevation, lat, long, point.mean_temp, point.avg_diurnal_range)
+
 def make_profile_comparative_json(profiles):
     """
     returns a list of dicts from the pre-made profiles containing only the data we want to compare to the queried location
@@ -148,28 +215,31 @@ def make_profile_comparative_json(profiles):
 
     return list_of_dicts
 
+@timed('get_location_temp')
+@single_flight(lambda lat, long: quantize(lat, long))
 def get_location_temp(lat,long):
+    initialize()
     
     point = ee.Geometry.Point(long,lat)
-    image = ee.Image("WORLDCLIM/V1/BIO")
-    image = image.multiply(0.1)
-    dataset = image.select("bio01")
-    
+    dataset = get_image("temp")
+
     mean_dict = dataset.reduceRegion(
         reducer=ee.Reducer.mean(),
         geometry=point,
         scale=30,
         maxPixels=1,
     )
-    info = mean_dict.getInfo()
+    info = get_info(mean_dict)
     mean = round(sum(info.values()), 2)
     return mean
 
 
+@timed('get_location_diurnal_range')
+@single_flight(lambda long, lat: quantize(lat, long))
 def get_location_diurnal_range(long, lat):
+    initialize()
     ee_geometry = ee.Geometry.Point(long, lat)
-    image = ee.Image("OpenLandMap/CLM/CLM_LST_MOD11A2-DAYNIGHT_M/v01").select('may', 'jun','jul', 'aug','sep')
-    image = image.multiply(0.02)
+    image = get_image("diurnal_months")
 
     mean_dict = image.reduceRegion(
         reducer=ee.Reducer.mean(),
@@ -177,7 +247,74 @@ def get_location_diurnal_range(long, lat):
         scale=30,
         maxPixels=1e9
     )
-    mean_diurnal_range = mean_dict.getInfo()
+    mean_diurnal_range = get_info(mean_dict)
 
     mean = round(sum(mean_diurnal_range.values()) / len(mean_diurnal_range),2)
-    return mean
\ No newline at end of file
+    return mean
+
+
+def point_calls(backend, lat, long, buffer=1000):
+    """
+    The independent lookups of a location as {name: (function, args)}, names are the keys fetch_point_concurrently returns.
+    """
+    poi = (long, lat)
+    return {
+        "sand": (backend.soil_profile, ("sand", poi, buffer)),
+        "clay": (backend.soil_profile, ("clay", poi, buffer)),
+        "orgc": (backend.soil_profile, ("orgc", poi, buffer)),
+        "mean_temp": (backend.location_temp, (lat, long)),
+        "avg_diurnal_range": (backend.diurnal_range, (long, lat)),
+        "elevation": (backend.elevation, (lat, long)),
+    }
+
+
+def fetch_point_concurrently(backend, lat, long, buffer=1000, timeout=10, max_workers=6):
+    """
+    Issues the independent point lookups (3 soil profiles, temperature, diurnal range, elevation) at the same time
+    so a click costs the slowest call instead of the sum of all of them.
+    backend is an object like backends.EarthEngineBackend.
+    Returns (results, errors), both keyed by "sand", "clay", "orgc", "mean_temp", "avg_diurnal_range", "elevation".
+    Anything that raised or did not finish within timeout seconds ends up in errors instead of results.
+    """
+    results = {}
+    errors = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {name: executor.submit(func, *args) for name, (func, args) in point_calls(backend, lat, long, buffer).items()}
+    # Every call started together so one shared deadline is a per-call timeout.
+    deadline = time.monotonic() + timeout
+    for name, future in futures.items():
+        try:
+            results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeout:
+            errors[name] = TimeoutError(f'{name} lookup took longer than {timeout}s')
+        except Exception as e:
+            errors[name] = e
+    # Don't wait on calls that timed out, their threads finish in the background.
+    executor.shutdown(wait=False, cancel_futures=True)
+    return results, errors
+
+
+def make_queried_json_concurrently(backend, lat, long, buffer=1000, timeout=10):
+    """
+    Same output as make_queried_json but the lookups are fetched with fetch_point_concurrently.
+    Returns (location_dict, errors), location_dict is None if any lookup failed.
+    """
+    results, errors = fetch_point_concurrently(backend, lat, long, buffer, timeout)
+    return location_from_results(results, errors, lat, long)
+
+
+def location_from_results(results, errors, lat, long):
+    """
+    Builds the make_queried_json dict from the point_calls results.
+    Returns (location_dict, errors), location_dict is None if any lookup failed.
+    """
+    errors = dict(errors)
+    # local_profile returns a string instead of a dict when there is no soil data.
+    for param in ("sand", "clay", "orgc"):
+        if param in results and not isinstance(results[param], dict):
+            errors[param] = ValueError(f'No {param} data at this location')
+    if errors:
+        return None, errors
+    soil = SoilProfile.from_bands(results["sand"], results["clay"], results["orgc"], soil_aggregation)
+    location_dict = make_queried_json(soil, results["elevation"], lat, long, results["mean_temp"], results["avg_diurnal_range"])
+    return location_dict, errors
@@ -0,0 +1,111 @@
+import json
+import math
+import os
+import numpy as np
+
+# Full-resolution polygons are moved here so profiles.json only carries the simplified ones.
+full_geometry_path = 'Profiles/geometries.json'
+# Maximum distance in degrees (~100 m) a simplified vertex may move from the original outline.
+default_tolerance = 0.001
+# Native resolution of the finest dataset (NASADEM), the reduction scale never goes below it.
+min_scale = 30
+
+# {path: {region name: geometry}}, filled on first use.
+_full_geometries = {}
+
+
+def simplify(coordinates, tolerance=default_tolerance):
+    """
+    Douglas-Peucker simplification of a list of [lng, lat] vertices, every dropped vertex lies within
+    tolerance degrees of the simplified outline. Returns the original list when it would collapse below a triangle.
+    """
+    points = np.asarray(coordinates, dtype=float)
+    if len(points) <= 4:
+        return coordinates
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            # Closed rings start and end on the same vertex, fall back to distance from that vertex.
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+    simplified = points[keep].tolist()
+    if len(simplified) < 3:
+        return coordinates
+    return simplified
+
+
+def bbox(coordinates):
+    """
+    [west, south, east, north] of a list of [lng, lat] vertices, the GeoJSON bbox order.
+    """
+    points = np.asarray(coordinates, dtype=float)
+    return [float(points[:, 0].min()), float(points[:, 1].min()), float(points[:, 0].max()), float(points[:, 1].max())]
+
+
+def area_km2(coordinates):
+    """
+    Approximate area of the polygon, shoelace formula on an equirectangular projection around its centre.
+    """
+    points = np.asarray(coordinates, dtype=float)
+    km_per_degree = 111.32
+    x = points[:, 0] * km_per_degree * math.cos(math.radians(points[:, 1].mean()))
+    y = points[:, 1] * km_per_degree
+    return float(abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2)
+
+
+def reduction_scale(coordinates, max_pixels=1e8):
+    """
+    reduceRegion scale in metres for a region, the native 30 m unless that would go over max_pixels.
+    """
+    area_m2 = area_km2(coordinates) * 1e6
+    return max(min_scale, int(math.ceil(math.sqrt(area_m2 / max_pixels))))
+
+
+def preprocess_profiles(profiles, tolerance=default_tolerance, path=full_geometry_path):
+    """
+    Simplifies every region that hasn't been preprocessed yet (no bbox) and stores its
+    full-resolution geometry in path. Returns True if anything changed.
+    """
+    new_regions = [region for region in profiles["profiles"] if "bbox" not in region]
+    if not new_regions:
+        return False
+    full = load_full_geometries(path)
+    for region in new_regions:
+        coordinates = region["geometry"]["coordinates"]
+        full[region["properties"]["region"]] = region["geometry"]
+        region["geometry"] = dict(region["geometry"], coordinates=simplify(coordinates, tolerance))
+        region["bbox"] = bbox(coordinates)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(full))
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def load_full_geometries(path=full_geometry_path):
+    """
+    {region name: full-resolution geometry}, read from disk the first time it's needed.
+    """
+    if path not in _full_geometries:
+        if os.path.exists(path):
+            with open(path) as f:
+                _full_geometries[path] = json.load(f)
+        else:
+            _full_geometries[path] = {}
+    return _full_geometries[path]
+
@@ -0,0 +1,88 @@
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for reset_timeout seconds after failure_threshold failures in a row.
+    Once the timeout passes one trial call is let through, success closes the circuit again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            # Half open, this call is the only one let through until it succeeds or fails.
+            self.trial = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            # A failed trial re-opens the circuit straight away.
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+def make_session(pool_size=10, retries=2, backoff=0.3):
+    """
+    requests.Session with a keep-alive connection pool and bounded retries with exponential backoff
+    on connection errors and 429/5xx responses.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class JsonClient:
+    """
+    Shared session plus circuit breaker for one upstream service.
+    get_json raises CircuitOpenError without making a request while the circuit is open.
+    """
+
+    def __init__(self, timeout=(3.05, 5), **session_options):
+        self.timeout = timeout
+        self.session = make_session(**session_options)
+        self.breaker = CircuitBreaker()
+
+    def get_json(self, url, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError(url)
+        try:
+            response = self.session.get(url, timeout=self.timeout, **kwargs)
+            response.raise_for_status()
+            data = response.json()
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return data
@@ -0,0 +1,100 @@
+import time
+from concurrent.futures import CancelledError, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from data_analysis import location_from_results, point_calls
+from metrics import metrics
+
+
+class PointJob:
+    """
+    The lookups of one clicked location (data_analysis.point_calls) running in the background on a JobRunner.
+    The page reads them as they finish with updates instead of waiting for the slowest one.
+    """
+
+    def __init__(self, lat, long, futures):
+        self.lat = lat
+        self.long = long
+        self.futures = futures
+        self.started = time.perf_counter()
+        self.cancelled = False
+
+    def matches(self, lat, long):
+        return (self.lat, self.long) == (lat, long) and not self.cancelled
+
+    def done(self):
+        return all(future.done() for future in self.futures.values())
+
+    def cancel(self):
+        """
+        Drops the lookups that haven't started yet, the ones already running finish but nothing waits on them.
+        Only a job that was still pending counts as cancelled, not one that had already finished.
+        """
+        if self.cancelled:
+            return
+        self.cancelled = True
+        pending = not self.done()
+        dropped = sum(future.cancel() for future in self.futures.values())
+        if pending:
+            metrics.increment('jobs_cancelled')
+        metrics.increment('lookups_cancelled', dropped)
+
+    def result(self, name):
+        """
+        (value, None) for a finished lookup, (None, exception) for one that failed, was cancelled or is still running.
+        """
+        future = self.futures[name]
+        if future.cancelled():
+            return None, CancelledError(f'{name} lookup was cancelled')
+        if not future.done():
+            return None, TimeoutError(f'{name} lookup has not finished')
+        error = future.exception()
+        if error is not None:
+            return None, error
+        return future.result(), None
+
+    def updates(self, timeout=10, poll=0.25):
+        """
+        Yields the name of each lookup as it finishes, and None every poll seconds while waiting so the caller
+        can refresh the page (Streamlit only stops a run superseded by a new click when it writes something).
+        Stops after timeout seconds, unfinished lookups then show up as errors in location.
+        """
+        names = {future: name for name, future in self.futures.items()}
+        pending = set(names)
+        deadline = time.monotonic() + timeout
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            done, pending = wait(pending, timeout=min(poll, remaining), return_when=FIRST_COMPLETED)
+            if not done:
+                yield None
+            for future in done:
+                yield names[future]
+
+    def location(self):
+        """
+        (location_dict, errors) like data_analysis.make_queried_json_concurrently.
+        """
+        results = {}
+        errors = {}
+        for name in self.futures:
+            value, error = self.result(name)
+            if error is None:
+                results[name] = value
+            else:
+                errors[name] = error
+        return location_from_results(results, errors, self.lat, self.long)
+
+
+class JobRunner:
+    """
+    One bounded thread pool shared by every session's click lookups, so slow upstream calls queue here
+    instead of each click starting threads of its own.
+    """
+
+    def __init__(self, max_workers=12):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='point-job')
+
+    def submit(self, backend, lat, long, buffer=1000):
+        futures = {name: self.executor.submit(func, *args) for name, (func, args) in point_calls(backend, lat, long, buffer).items()}
+        metrics.increment('jobs_submitted')
+        return PointJob(lat, long, futures)
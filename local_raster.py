@@ -0,0 +1,168 @@
+import json
+import math
+import os
+import re
+import numpy as np
+import cloud
+
+# Every layer a point query reads. The soil layers are the per-depth bands of cloud.get_data, so the depth aggregation
+# (cloud.soil_aggregation) is applied when reading and can change without exporting again.
+# The other three are bands of cloud.get_point_image.
+soil_bands = [f'{param}_{band}' for param in cloud.soil_params for band in cloud.olm_bands]
+point_image_bands = ['temp', 'diurnal', 'elevation']
+point_bands = soil_bands + point_image_bands
+
+
+class NumpyTileSource:
+    """
+    A directory of memory-mapped .npy layers, one per band, sharing the grid described in manifest.json:
+        {"bounds": [west, south, east, north], "resolution": degrees per cell, "bands": [...]}
+    Row 0 is the northern edge. Only the cells inside a read window are paged in.
+    """
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.layers = {band: np.load(os.path.join(directory, f'{band}.npy'), mmap_mode='r') for band in self.manifest["bands"]}
+
+    def read_window(self, band, lat, long, lat_radius, long_radius):
+        """
+        Cells of band within the radii (degrees) of the location, an empty array outside the grid.
+        """
+        west, south, east, north = self.manifest["bounds"]
+        resolution = self.manifest["resolution"]
+        layer = self.layers[band]
+        row, col = math.floor((north - lat) / resolution), math.floor((long - west) / resolution)
+        rows, cols = int(lat_radius / resolution), int(long_radius / resolution)
+        row_start, col_start = max(0, row - rows), max(0, col - cols)
+        return np.asarray(layer[row_start:max(row_start, row + rows + 1), col_start:max(col_start, col + cols + 1)], dtype=float)
+
+
+class GeoTiffSource:
+    """
+    A directory of single-band Cloud-Optimized GeoTIFFs named <band>.tif, as written by export_point_image.
+    Reads are windowed so only the overlapping internal tiles are fetched. Needs rasterio.
+    """
+
+    def __init__(self, directory):
+        import rasterio
+        self.files = {}
+        for name in os.listdir(directory):
+            if name.endswith('.tif'):
+                if re.search(r'-\d{10}-\d{10}\.tif$', name):
+                    # Earth Engine split the export, a band would be read from one shard only.
+                    raise ValueError(f'{name} is one shard of a split export, mosaic the shards into one <band>.tif')
+                self.files[name[:-len('.tif')]] = rasterio.open(os.path.join(directory, name))
+
+    def read_window(self, band, lat, long, lat_radius, long_radius):
+        from rasterio.windows import Window
+        src = self.files[band]
+        # Same window as NumpyTileSource, the pixel holding the location and whole pixels on either side of it.
+        row, col = src.index(long, lat)
+        rows, cols = int(lat_radius / abs(src.res[1])), int(long_radius / abs(src.res[0]))
+        window = Window(col - cols, row - rows, 2 * cols + 1, 2 * rows + 1)
+        data = src.read(1, window=window, boundless=True, fill_value=src.nodata if src.nodata is not None else np.nan, masked=False)
+        data = data.astype(float)
+        if src.nodata is not None:
+            data[data == src.nodata] = np.nan
+        return data
+
+
+class LocalRasterBackend:
+    """
+    Answers point queries from locally exported rasters instead of Earth Engine, same methods as backends.EarthEngineBackend.
+    Values are the mean of the cells within buffer metres of the location, ignoring nodata.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    @classmethod
+    def open(cls, directory):
+        if os.path.exists(os.path.join(directory, 'manifest.json')):
+            return cls(NumpyTileSource(directory))
+        return cls(GeoTiffSource(directory))
+
+    def read(self, band, lat, long, buffer):
+        # Half the buffer on either side, a degree of longitude shrinks with the cosine of the latitude.
+        lat_radius = buffer / 2 / 111320
+        window = self.source.read_window(band, lat, long, lat_radius, lat_radius / math.cos(math.radians(lat)))
+        if window.size == 0 or np.isnan(window).all():
+            return None
+        return float(np.nanmean(window))
+
+    def soil_profile(self, param, poi, buffer):
+        long, lat = poi
+        profile = {band: self.read(f'{param}_{band}', lat, long, buffer) for band in cloud.olm_bands}
+        if any(value is None for value in profile.values()):
+            return 'No data :('
+        return {band: round(value, 5) for band, value in profile.items()}
+
+    def location_temp(self, lat, long):
+        value = self.read('temp', lat, long, 30)
+        return None if value is None else round(value, 2)
+
+    def diurnal_range(self, long, lat):
+        value = self.read('diurnal', lat, long, 30)
+        return None if value is None else round(value, 2)
+
+    def elevation(self, lat, long):
+        value = self.read('elevation', lat, long, 30)
+        return None if value is None else round(value, 2)
+
+    def query_point(self, poi, buffer):
+        long, lat = poi
+        values = {band: self.read(band, lat, long, buffer) for band in point_bands}
+        if any(value is None for value in values.values()):
+            return None
+        return cloud.point_profile(values)
+
+    def sample_points(self, points, buffer):
+        return [self.query_point((long, lat), buffer) for lat, long in points]
+
+
+def write_numpy_tiles(directory, bounds, resolution, layers):
+    """
+    Writes {band: 2D array} as a NumpyTileSource directory, NaN marks nodata.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for band, array in layers.items():
+        np.save(os.path.join(directory, f'{band}.npy'), np.asarray(array, dtype=np.float32))
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        f.write(json.dumps({"bounds": list(bounds), "resolution": resolution, "bands": list(layers)}, indent = 4))
+
+
+def export_point_image(bucket, prefix='rasters', bounds=(-141.0, 41.6, -52.6, 83.2), scale=250):
+    """
+    Starts one Earth Engine export task per layer in point_bands, written to Cloud Storage as
+    Cloud-Optimized GeoTIFFs named <band>.tif. Download them into a directory and open it with LocalRasterBackend.open.
+    """
+    import ee
+    region = ee.Geometry.Rectangle(list(bounds))
+    # Earth Engine splits larger exports into <band>-XXXXXXXXXX-XXXXXXXXXX.tif shards, so the file is made big enough
+    # for the whole region, a multiple of the default 256 pixel shard size.
+    west, south, east, north = bounds
+    degrees = scale / 111320
+    file_dimensions = [256 * math.ceil((east - west) / degrees / 256), 256 * math.ceil((north - south) / degrees / 256)]
+    tasks = []
+    for band in point_bands:
+        if band in point_image_bands:
+            image = cloud.get_point_image().select(band)
+        else:
+            param, depth = band.split('_')
+            image = cloud.get_data(param).select(depth)
+        task = ee.batch.Export.image.toCloudStorage(
+            image=image.toFloat(),
+            description=f'export_{band}',
+            bucket=bucket,
+            fileNamePrefix=f'{prefix}/{band}',
+            region=region,
+            scale=scale,
+            crs='EPSG:4326',
+            maxPixels=1e13,
+            fileDimensions=file_dimensions,
+            formatOptions={'cloudOptimized': True},
+        )
+        task.start()
+        tasks.append(task)
+    return tasks
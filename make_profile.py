@@ -1,122 +1,150 @@
 import ee
+import hashlib
 import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import cloud
-
-ee.Initialize()
+import compiled_catalogue
+import geometry
+from ratelimit import BUILD, run_at
+
+# Per-region results are saved here as soon as they are computed, named by region_hash.
+checkpoint_dir = 'Profiles/checkpoints'
+# Every dataset that goes into a profile, changing this list invalidates every checkpoint.
+datasets = [
+    'NASA/NASADEM_HGT/001:elevation',
+    'OpenLandMap/SOL/SOL_SAND-WFRACTION_USDA-3A1A1A_M/v02',
+    'OpenLandMap/SOL/SOL_CLAY-WFRACTION_USDA-3A1A1A_M/v02',
+    'OpenLandMap/SOL/SOL_ORGANIC-CARBON_USDA-6A1C_M/v02',
+    'OpenLandMap/CLM/CLM_LST_MOD11A2-DAYNIGHT_M/v01:' + ','.join(cloud.diurnal_months),
+    'WORLDCLIM/V1/BIO:bio01',
+    'soil_aggregation:' + cloud.soil_aggregation,
+]
 
 # Main file for creating the profiles, can do everything programatically once the coordinates are in the profile.
-def main():
-
-    with open('profiles.json', 'r') as f:
+# Only regions whose geometry or dataset list changed since their last checkpoint are sent to Earth Engine.
+# compute replaces compute_region (the benchmarks pass a fake), the paths default to the repo's files.
+def main(max_workers=4, path='profiles.json', compute=None, checkpoints=checkpoint_dir, geometries=geometry.full_geometry_path,
+         compiled=compiled_catalogue.compiled_path):
+    if compute is None:
+        cloud.initialize()
+        compute = compute_region
+
+    with open(path, 'r') as f:
         dict_profiles = json.load(f)
-
-    profile_json = {"profiles" : []}
-    for region in dict_profiles["profiles"]:
-        new_region = region
-        new_region["properties"]["mean_elevation"] = get_mean_elevation(region["geometry"]["coordinates"])
-        new_region["properties"]["mean_soil_content_%"] = profile_mean_soil_content(region["geometry"]["coordinates"])
-        new_region["properties"]["avg_diurnal_range"] = get_diurnal_range(region["geometry"]["coordinates"])
-        new_region["properties"]["mean_temp"] = get_mean_temp(region["geometry"]["coordinates"])
-        print('\n', new_region)
-        profile_json["profiles"].append(new_region)
-    
-
-    with open('profiles.json', 'w') as t:
-        t.write(json.dumps(profile_json, indent = 4, sort_keys = True))
-    
-
-def get_mean_elevation(bounding_geometry):
+    os.makedirs(checkpoints, exist_ok=True)
+    # New regions get a simplified outline and bbox, their full geometry moves to geometries.
+    geometry.preprocess_profiles(dict_profiles, path=geometries)
+
+    to_compute = {}
+    for i, region in enumerate(dict_profiles["profiles"]):
+        checkpoint = load_checkpoint(checkpoints, region_hash(region))
+        if checkpoint is None:
+            to_compute[i] = region
+        else:
+            region["properties"].update(checkpoint)
+    print(f'{len(to_compute)} of {len(dict_profiles["profiles"])} regions need to be computed')
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for i, region in to_compute.items():
+            coordinates = region["geometry"]["coordinates"]
+            # At build priority so a rebuild never holds up the app's clicks (ratelimit.limiter).
+            futures[executor.submit(run_at, BUILD, compute, coordinates, geometry.reduction_scale(coordinates))] = i
+        for future in as_completed(futures):
+            region = to_compute[futures[future]]
+            name = region["properties"]["region"]
+            try:
+                values = future.result()
+            except Exception as e:
+                # Keep the values already in profiles.json, the next run retries this region.
+                print(f'\n{name} failed: {e}')
+                failed.append(name)
+                continue
+            save_checkpoint(checkpoints, region_hash(region), values)
+            region["properties"].update(values)
+            print('\n', region)
+
+    write_json_atomic(path, dict_profiles)
+    # The app loads this instead of parsing profiles.json (catalogue.ProfileCatalogue.load).
+    compiled_catalogue.write(dict_profiles, compiled, path)
+    if failed:
+        print(f'\nFailed regions, run again to retry: {", ".join(failed)}')
+
+
+def region_hash(region):
     """
-    Returns a mean elevation for queried region as int.
-    Uses ee.reduceRegion to get stats
+    Content hash of everything a profile's computed values depend on.
     """
-    ee_geometry = ee.Geometry.Polygon(bounding_geometry)
-    
+    content = json.dumps({
+        "geometry": region["geometry"],
+        "datasets": datasets,
+        "scale": geometry.reduction_scale(region["geometry"]["coordinates"]),
+    }, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
 
-    image = ee.Image('NASA/NASADEM_HGT/001').clip(ee_geometry).select('elevation')
-    mean_dict = image.reduceRegion(
-        reducer=ee.Reducer.mean(),
-        geometry=ee_geometry,
-        scale=30,
-        maxPixels=1e9
-    )
-    
-    mean_elevation = (round(mean_dict.get('elevation').getInfo(),2))
 
-    return mean_elevation
+def load_checkpoint(checkpoints, key):
+    path = os.path.join(checkpoints, f'{key}.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
 
-def profile_mean_soil_content(queried_polygon):
 
-    ee_geometry = ee.Geometry.Polygon(queried_polygon)
-    sand = cloud.get_data("sand").clip(ee_geometry)
-    clay = cloud.get_data("clay").clip(ee_geometry)
-    orgc = cloud.get_data("orgc").clip(ee_geometry)
-    
+def save_checkpoint(checkpoints, key, values):
+    write_json_atomic(os.path.join(checkpoints, f'{key}.json'), values)
 
-    sand_dict = sand.reduceRegion(
-        reducer=ee.Reducer.mean(),
-        geometry=ee_geometry,
-    )
-    clay_dict = clay.reduceRegion(
-        reducer=ee.Reducer.mean(),
-        geometry=ee_geometry,
-    )
-    orgc_dict = orgc.reduceRegion(
-        reducer=ee.Reducer.mean(),
-        geometry=ee_geometry,
-    )
-
-    sand = create_soil_data(sand_dict)
-    clay = create_soil_data(clay_dict)
-    orgc = create_soil_data(orgc_dict)
-    profile = { "Sand": sand,
-                "Clay" : clay,
-                "Organic Matter" : orgc,
-                "Other": round(100 - (sand + clay + orgc), 2)}
-    return profile
-
-def create_soil_data(soil_dict):
-    # Soil depths [in cm] where we have data.
-    olm_depths = [0, 10, 30, 60, 100, 200]
-    # Names of bands associated with reference depths.
-    olm_bands = ["b" + str(sd) for sd in olm_depths]
-
-    sum = 0
-    for band in olm_bands:
-        sum = sum + soil_dict.get(band).getInfo()
-    
-    return round(sum / len(olm_bands)*100,3)
-
-def get_diurnal_range(bounding_geometry):
-    ee_geometry = ee.Geometry.Polygon(bounding_geometry)
-    image = ee.Image("OpenLandMap/CLM/CLM_LST_MOD11A2-DAYNIGHT_M/v01").clip(ee_geometry).select('may', 'jun','jul', 'aug','sep')
-    image = image.multiply(0.02)
 
-    mean_dict = image.reduceRegion(
-        reducer=ee.Reducer.mean(),
-        geometry=ee_geometry,
-        scale=30,
-        maxPixels=1e9
-    )
-    mean_diurnal_range = mean_dict.getInfo()
+def write_json_atomic(path, data):
+    # Write to a temporary file first so a crash never leaves a truncated file behind.
+    with open(path + '.tmp', 'w') as t:
+        t.write(json.dumps(data, indent = 4, sort_keys = True))
+    os.replace(path + '.tmp', path)
+
+
+def region_image():
+    """
+    Returns one ee.Image with every band a region profile needs so the region is reduced in a single request.
+    Built once and shared by every region (cloud.get_image).
+    """
+    def build():
+        # One band per soil type, aggregated over depth inside Earth Engine.
+        soil = [cloud.aggregate_soil(cloud.get_data(param)).rename(param) for param in cloud.soil_params]
+        diurnal = cloud.get_image("diurnal_months").rename([f'diurnal_{month}' for month in cloud.diurnal_months])
+        return ee.Image.cat([cloud.get_image("nasadem")] + soil + [diurnal, cloud.get_image("temp")])
+    return cloud.get_image(f'region_{cloud.soil_aggregation}', build)
 
-    mean = round(sum(mean_diurnal_range.values()) / len(mean_diurnal_range), 2)
-    return mean
 
-def get_mean_temp(bounding_geometry):
-    
+def compute_region(bounding_geometry, scale=30):
+    """
+    Reduces region_image over the region with one reduceRegion and returns the computed profile properties.
+    scale comes from geometry.reduction_scale so large regions stay under maxPixels.
+    """
     ee_geometry = ee.Geometry.Polygon(bounding_geometry)
-    image = ee.Image("WORLDCLIM/V1/BIO")
-    dataset = image.select("bio01")
-    
-    mean_dict = dataset.reduceRegion(
+    mean_dict = cloud.get_info(region_image().reduceRegion(
         reducer=ee.Reducer.mean(),
         geometry=ee_geometry,
-        scale=30,
+        scale=scale,
         maxPixels=1e9
-    )
-    value = list(mean_dict.getInfo().values())
-
-    return round((value[0]*0.1), 2)
-
-main()
\ No newline at end of file
+    ))
+
+    sand = round(mean_dict['sand'] * 100, 3)
+    clay = round(mean_dict['clay'] * 100, 3)
+    orgc = round(mean_dict['orgc'] * 100, 3)
+    diurnal = [mean_dict[f'diurnal_{month}'] for month in cloud.diurnal_months]
+
+    return {
+        "mean_elevation": round(mean_dict['elevation'], 2),
+        "mean_soil_content_%": {
+            "Sand": sand,
+            "Clay" : clay,
+            "Organic Matter" : orgc,
+            "Other": round(100 - (sand + clay + orgc), 2)},
+        "avg_diurnal_range": round(sum(diurnal) / len(diurnal), 2),
+        "mean_temp": round(mean_dict['temp'], 2),
+    }
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets.
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q quantile, inf if it's past the last bucket.
+        """
+        if self.count == 0:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+
+class LogSink:
+    """
+    Logs every observation as a line, e.g. "metric comparison seconds=0.0004".
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger('vineyard.metrics')
+
+    def observe(self, name, value):
+        self.logger.info(f'metric {name} seconds={value:.4f}')
+
+    def increment(self, name, amount):
+        self.logger.info(f'metric {name} +{amount}')
+
+
+class Registry:
+    """
+    Process-wide latency histograms, counters and gauges (current values, like a queue depth).
+    Sinks get every observation and increment as it happens,
+    anything with observe(name, seconds) and increment(name, amount) methods can be added.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.sinks = []
+        self.lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms.setdefault(name, Histogram()).observe(value)
+        for sink in self.sinks:
+            sink.observe(name, value)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        for sink in self.sinks:
+            sink.increment(name, amount)
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self):
+        """
+        One row per histogram with count, mean and approximate p50/p95/p99, for the app's debug panel,
+        and the counters together with the gauges' current values.
+        """
+        with self.lock:
+            rows = []
+            for name, histogram in sorted(self.histograms.items()):
+                rows.append({
+                    "stage": name,
+                    "count": histogram.count,
+                    "mean_s": round(histogram.sum / histogram.count, 4) if histogram.count else None,
+                    "p50_s": histogram.quantile(0.5),
+                    "p95_s": histogram.quantile(0.95),
+                    "p99_s": histogram.quantile(0.99),
+                })
+            return rows, dict(self.counters, **self.gauges)
+
+    def prometheus_text(self):
+        """
+        Everything in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for name, histogram in sorted(self.histograms.items()):
+                metric = f'vineyard_{name}_seconds'
+                lines.append(f'# TYPE {metric} histogram')
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f'{metric}_sum {histogram.sum}')
+                lines.append(f'{metric}_count {histogram.count}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE vineyard_{name}_total counter')
+                lines.append(f'vineyard_{name}_total {value}')
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f'# TYPE vineyard_{name} gauge')
+                lines.append(f'vineyard_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Registry()
+
+
+def timed(name):
+    """
+    Decorator recording how long every call of the function takes under name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def serve_prometheus(port, registry=metrics):
+    """
+    Serves registry.prometheus_text() at http://localhost:port/metrics from a background thread.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.prometheus_text().encode()
+            self.send_response(200 if self.path == '/metrics' else 404)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.end_headers()
+            if self.path == '/metrics':
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,120 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from metrics import metrics
+
+
+class MemoryStore:
+    """
+    In-process LRU store, shared by every session in one Streamlit process.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value, stored_at):
+        with self.lock:
+            self.entries[key] = (value, stored_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class SQLiteStore:
+    """
+    On-disk LRU store so every Streamlit worker process on the machine shares the same cached points.
+    Values are stored as JSON.
+    """
+
+    def __init__(self, path, max_entries=100000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        # WAL lets readers in other processes carry on while one process writes.
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS points (key TEXT PRIMARY KEY, value TEXT, stored_at REAL, used_at REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS points_used_at ON points (used_at)')
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT value, stored_at FROM points WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute('UPDATE points SET used_at = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, stored_at):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?)',
+                              (key, json.dumps(value), stored_at, time.time()))
+            self.conn.execute(
+                'DELETE FROM points WHERE key IN (SELECT key FROM points ORDER BY used_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute('DELETE FROM points WHERE key = ?', (key,))
+
+
+class PointCache:
+    """
+    Caches queried location profiles (the dict make_queried_json returns) per map cell.
+    Clicks are snapped to a grid of cell_size degrees (0.01 is roughly 1 km) and keyed together with the
+    dataset version, so changing a dataset in cloud.py never serves stale values.
+    Entries older than ttl seconds are treated as misses.
+    """
+
+    def __init__(self, store, ttl=7 * 24 * 3600, cell_size=0.01, version=''):
+        self.store = store
+        self.ttl = ttl
+        self.cell_size = cell_size
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, lat, long):
+        return f'{self.version}:{round(lat / self.cell_size)}:{round(long / self.cell_size)}'
+
+    def get(self, lat, long):
+        key = self.key(lat, long)
+        entry = self.store.get(key)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            self.store.delete(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            metrics.increment('point_cache_misses')
+            return None
+        self.hits += 1
+        metrics.increment('point_cache_hits')
+        return entry[0]
+
+    def set(self, lat, long, location_dict):
+        self.store.set(self.key(lat, long), location_dict, time.time())
+
+
+def make_point_cache(path=None, version='', **kwargs):
+    """
+    Returns a PointCache backed by SQLite when path is given, otherwise by an in-process MemoryStore.
+    """
+    if path:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return PointCache(SQLiteStore(path), version=version, **kwargs)
+    return PointCache(MemoryStore(), version=version, **kwargs)
@@ -0,0 +1,206 @@
+import contextlib
+import heapq
+import itertools
+import random
+import threading
+import time
+from metrics import metrics
+
+# Lower runs first. Clicks are interactive unless the caller says otherwise (with priority(...)).
+INTERACTIVE = 0
+BATCH = 1
+BUILD = 2
+priority_names = {INTERACTIVE: 'interactive', BATCH: 'batch', BUILD: 'build'}
+
+# HTTP status of a throttled request.
+too_many_requests = 429
+
+
+def status_code(error):
+    """
+    HTTP status an error carries, None when it has none. Knows requests' HTTPError (response.status_code),
+    googleapiclient's HttpError (resp.status) and errors with their own status_code.
+    """
+    status = getattr(error, 'status_code', None)
+    for name in ('response', 'resp'):
+        response = getattr(error, name, None)
+        if status is None and response is not None:
+            status = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+    return status if isinstance(status, int) else None
+
+
+def is_throttled(error):
+    """
+    True when error, or an error it was raised from, is a 429. Earth Engine raises its EEException
+    while handling the client's HttpError, so the status is found on the exception's context.
+    """
+    return any(status == too_many_requests for status in chain_statuses(error))
+
+
+def is_retryable(error):
+    """
+    Throttled or a server error (5xx), what AdaptiveLimiter.call retries.
+    """
+    return any(status == too_many_requests or status >= 500 for status in chain_statuses(error))
+
+
+def chain_statuses(error):
+    seen = set()
+    while error is not None and id(error) not in seen:
+        status = status_code(error)
+        if status is not None:
+            yield status
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+
+
+_context = threading.local()
+
+
+def current_priority():
+    return getattr(_context, 'priority', INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level):
+    """
+    Earth Engine requests made by this thread inside the block are queued at level.
+    Threads don't inherit it, so code handing work to an executor sets it in the submitted function (see run_at).
+    """
+    previous = current_priority()
+    _context.priority = level
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def run_at(level, func, *args, **kwargs):
+    """
+    Calls func with its Earth Engine requests at priority level, for executor.submit(run_at, BATCH, func, ...).
+    """
+    with priority(level):
+        return func(*args, **kwargs)
+
+
+class AdaptiveLimiter:
+    """
+    Shared gate in front of every Earth Engine request.
+        rate, burst - token bucket, at most rate requests start per second, burst of them at once
+        limit       - requests in flight at the same time, adapted with AIMD: +1 per limit successful requests,
+                      halved (decrease) on a throttled one, between min_limit and max_limit
+        retries     - times call retries a throttled or failed (5xx) request, after a jittered exponential backoff
+                      from backoff seconds
+    Waiting requests are served lowest priority first, then in arrival order, so clicks overtake a profile rebuild.
+    The limiter is the only layer retrying throttled Earth Engine requests: cloud.limited_call turns off the client's
+    own retries and batch.sample_with_retry leaves throttled chunks to it, so attempts don't multiply.
+    There is one limiter per process. The app, the scoring service and each of its workers throttle on their own,
+    so together they can start more than rate requests per second, each still backs off on the 429s it gets.
+    """
+
+    def __init__(self, rate=10.0, burst=10, limit=6, min_limit=1, max_limit=40, decrease=0.5, retries=4, backoff=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.retries = retries
+        self.backoff = backoff
+        self.in_flight = 0
+        self.waiting = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def acquire(self, level=INTERACTIVE, timeout=None):
+        """
+        Blocks until the request may start. Raises TimeoutError after timeout seconds.
+        """
+        start = time.monotonic()
+        entry = (level, next(self.order))
+        with self.condition:
+            heapq.heappush(self.waiting, entry)
+            self._record()
+            try:
+                while True:
+                    self._refill()
+                    if self.waiting[0] == entry and self.in_flight < int(self.limit) and self.tokens >= 1:
+                        break
+                    # Woken by release, or when the next token is due.
+                    wait = None if self.tokens >= 1 else (1 - self.tokens) / self.rate
+                    if timeout is not None:
+                        remaining = timeout - (time.monotonic() - start)
+                        if remaining <= 0:
+                            raise TimeoutError(f'no Earth Engine capacity within {timeout}s')
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self.condition.wait(wait)
+            except BaseException:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self._record()
+                self.condition.notify_all()
+                raise
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.in_flight += 1
+            self._record()
+            self.condition.notify_all()
+        metrics.observe('ee_queue_wait', time.monotonic() - start)
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                metrics.increment('ee_throttled')
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._record()
+            self.condition.notify_all()
+
+    def _record(self):
+        # Called with the condition held, the gauges show the queue as it is right now.
+        for level, name in priority_names.items():
+            metrics.set_gauge(f'ee_queue_depth_{name}', sum(1 for waiter in self.waiting if waiter[0] == level))
+        metrics.set_gauge('ee_queue_depth', len(self.waiting))
+        metrics.set_gauge('ee_in_flight', self.in_flight)
+        metrics.set_gauge('ee_concurrency_limit', round(self.limit, 2))
+
+    @contextlib.contextmanager
+    def slot(self, level=None):
+        """
+        with limiter.slot(): ... holds one request's place, a block raising a throttling error counts as throttled.
+        """
+        self.acquire(current_priority() if level is None else level)
+        throttled = False
+        try:
+            yield
+        except Exception as e:
+            throttled = is_throttled(e)
+            raise
+        finally:
+            self.release(throttled)
+
+    def call(self, func, *args, **kwargs):
+        """
+        func(*args, **kwargs) inside a slot, retried after a jittered exponential backoff while it is throttled or fails with a 5xx.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with self.slot():
+                    return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not is_retryable(e):
+                    raise
+                metrics.increment('ee_retries')
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+limiter = AdaptiveLimiter()
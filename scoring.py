@@ -0,0 +1,128 @@
+import numpy as np
+
+# Columns of the reference matrix, in order.
+features = ["mean_elevation", "mean_temp", "Clay", "Organic Matter", "Other", "Sand", "avg_diurnal_range"]
+# Elevation is worth less since otherwise it would decide the most similar region on its own.
+# Diurnal range is stored but not scored, same as the original comparison.
+default_weights = np.array([0.02, 1, 1, 1, 1, 1, 0], dtype=float)
+
+
+def profile_vector(profile):
+    """
+    Flattens a location dict (make_queried_json) or a profile's properties into a row in feature order.
+    Raises TypeError when a value is missing, the same way the dict arithmetic used to.
+    """
+    soil = profile["mean_soil_content_%"]
+    values = [profile["mean_elevation"], profile["mean_temp"], soil["Clay"], soil["Organic Matter"],
+              soil["Other"], soil["Sand"], profile["avg_diurnal_range"]]
+    if any(value is None for value in values):
+        raise TypeError('Profile is missing values')
+    return np.array(values, dtype=float)
+
+
+def vector_profile(vector):
+    """
+    Inverse of profile_vector, returns a location dict in the make_queried_json shape.
+    """
+    values = [round(float(value), 2) for value in vector]
+    return {
+        "mean_elevation": values[0],
+        "mean_temp": values[1],
+        "mean_soil_content_%": {
+            "Clay": values[2],
+            "Organic Matter": values[3],
+            "Other": values[4],
+            "Sand": values[5],
+        },
+        "avg_diurnal_range": values[6],
+    }
+
+
+class ReferenceMatrix:
+    """
+    The profile catalogue as a (regions x features) array, built once when profiles.json is loaded
+    so scoring a location is a single vectorized operation.
+    metric is one of:
+        "l1"          - weighted sum of absolute differences (the original comparison)
+        "l2"          - weighted euclidean distance
+        "mahalanobis" - distance scaled by the covariance of the reference regions
+    """
+
+    def __init__(self, regions, matrix, weights=default_weights, metric="l1"):
+        self.regions = list(regions)
+        self.matrix = np.asarray(matrix, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.metric = metric
+        self._inverse_covariance = None
+
+    @classmethod
+    def from_profiles(cls, profiles, **kwargs):
+        regions = [region["properties"]["region"] for region in profiles["profiles"]]
+        matrix = np.array([profile_vector(region["properties"]) for region in profiles["profiles"]])
+        return cls(regions, matrix, **kwargs)
+
+    def inverse_covariance(self):
+        if self._inverse_covariance is None:
+            self._inverse_covariance = np.linalg.pinv(np.cov(self.matrix, rowvar=False))
+        return self._inverse_covariance
+
+    def score(self, queries, chunk_elements=4_000_000):
+        """
+        queries is one feature row or a (n x features) array.
+        Returns a (n x regions) array of scores, lower is more similar.
+        Queries are processed in chunks so the broadcasted differences stay around chunk_elements floats.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=float))
+        scores = np.empty((len(queries), len(self.regions)))
+        chunk = max(1, chunk_elements // max(1, self.matrix.size))
+        for start in range(0, len(queries), chunk):
+            diff = queries[start:start + chunk, None, :] - self.matrix[None, :, :]
+            if self.metric == "l1":
+                result = np.abs(diff) @ self.weights
+            elif self.metric == "l2":
+                result = np.sqrt(np.square(diff) @ np.square(self.weights))
+            elif self.metric == "mahalanobis":
+                result = np.sqrt(np.einsum('qrf,fg,qrg->qr', diff, self.inverse_covariance(), diff).clip(min=0))
+            else:
+                raise ValueError(f'Unknown metric {self.metric}')
+            scores[start:start + chunk] = result
+        return scores
+
+    def rank(self, queries):
+        """
+        Returns (order, scores) for each query, order holds region indices from most to least similar
+        and scores are rounded to 2 decimals in that same order.
+        """
+        scores = np.round(self.score(queries), 2)
+        # Stable sort keeps the first region on ties, like the original loop did.
+        order = np.argsort(scores, axis=1, kind="stable")
+        return order, np.take_along_axis(scores, order, axis=1)
+
+    def contributions(self, query, indices):
+        """
+        How much each feature adds to the score of the regions at indices, a (len(indices) x features) array.
+        Sums to the score for l1 and to the squared score for l2 and mahalanobis.
+        """
+        diff = np.asarray(query, dtype=float)[None, :] - self.matrix[indices]
+        if self.metric == "l1":
+            return np.abs(diff) * self.weights
+        if self.metric == "l2":
+            return np.square(diff * self.weights)
+        return diff * (diff @ self.inverse_covariance())
+
+    def top_k(self, queries, k=3):
+        """
+        The k most similar regions for each query, without sorting the whole catalogue.
+        Returns (indices, scores), both (n x k), best first and scores rounded to 2 decimals.
+        Ties go to the region listed first in the catalogue, like comparison() and rank().
+        """
+        scores = np.round(self.score(queries), 2)
+        k = min(k, len(self.regions))
+        kth = np.partition(scores, k - 1, axis=1)[:, k - 1]
+        indices = np.empty((len(scores), k), dtype=int)
+        for row, (row_scores, threshold) in enumerate(zip(scores, kth)):
+            # Every region tied with the k-th best is a candidate, so argpartition can't drop the earlier one of a tie.
+            # flatnonzero lists them in catalogue order and the stable sort keeps that order on ties.
+            candidates = np.flatnonzero(row_scores <= threshold)
+            indices[row] = candidates[np.argsort(row_scores[candidates], kind="stable")[:k]]
+        return indices, np.take_along_axis(scores, indices, axis=1)
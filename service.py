@@ -0,0 +1,333 @@
+import argparse
+import multiprocessing
+import os
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import batch
+from catalogue import ProfileCatalogue
+from cloud import dataset_version
+from data_analysis import closest_regions, point_profile_json
+from metrics import metrics, timed
+from point_cache import make_point_cache
+from singleflight import SingleFlight, quantize
+
+# Where the service listens, only on this machine.
+service_address = ('127.0.0.1', 6001)
+# Random key the service creates on its first start, readable by its user only, see service_authkey.
+service_key_path = 'cache/service.key'
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+class ServiceError(Exception):
+    pass
+
+
+class ServiceTimeout(ServiceError):
+    pass
+
+
+def service_authkey(create=False, path=service_key_path):
+    """
+    The key the service and its clients authenticate each other with, messages are pickles so it must stay secret.
+    VINEYARD_SERVICE_KEY when set, otherwise the key in path, which the service (create=True) generates the first time.
+    """
+    key = os.environ.get('VINEYARD_SERVICE_KEY')
+    if key:
+        return key.encode()
+    if create:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+    elif not os.path.exists(path):
+        raise ServiceError(f'no service key at {path}, start the scoring service or set VINEYARD_SERVICE_KEY')
+    with open(path) as f:
+        return f.read().strip().encode()
+
+
+# State of a worker process, set once by init_worker so Earth Engine is initialized once per worker.
+_worker = {}
+
+
+def init_worker(backend_factory, backend_options, profiles_path):
+    _worker["backend"] = backend_factory(**backend_options)
+    _worker["reference"] = ProfileCatalogue.load(profiles_path).reference
+
+
+def worker_query(lat, long, buffer):
+    """
+    Runs in a worker: the make_queried_json dict of a location, None when it has no data.
+    """
+    point = _worker["backend"].query_point((long, lat), buffer)
+    if point is None:
+        return None
+    return point_profile_json(point, lat, long)
+
+
+def worker_score_points(points, buffer):
+    """
+    Runs in a worker: batch.score_points rows for one chunk of points.
+    """
+    return list(batch.score_points(points, _worker["reference"], _worker["backend"], chunk_size=len(points), max_workers=1, buffer=buffer))
+
+
+class ScoringService:
+    """
+    The query and compare pipeline behind one process, shared by every Streamlit session and batch job.
+    Earth Engine lookups run in a pool of worker processes, each with its own backend.
+    The service process keeps everything that has to be shared:
+        cache       - point_cache.PointCache of queried locations
+        flights     - identical queries in flight at the same time are fetched once
+        max_pending - work submitted to the pool and not finished yet, queries and batch chunks alike.
+                      Queries beyond it are refused with ServiceBusy instead of queueing up, batch chunks wait for a place
+        timeout     - seconds a query waits on its worker, chunk_timeout the same for a batch chunk
+    Clients talk to it through ServiceClient, the requests are pickled over a multiprocessing connection.
+    """
+
+    def __init__(self, backend_factory, backend_options=None, profiles_path='profiles.json', cache=None,
+                 workers=4, max_pending=64, buffer=1000, timeout=20, chunk_timeout=600):
+        # Workers are spawned, forking a process that already runs connection threads can deadlock the child.
+        self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker,
+                                        initargs=(backend_factory, backend_options or {}, profiles_path))
+        self.catalogue = ProfileCatalogue.load(profiles_path)
+        self.cache = cache if cache is not None else make_point_cache(None, version=dataset_version)
+        self.flights = SingleFlight()
+        self.workers = workers
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.buffer = buffer
+        self.timeout = timeout
+        self.chunk_timeout = chunk_timeout
+
+    @timed('service_query')
+    def query(self, lat, long, k=4):
+        """
+        {"location": make_queried_json dict, "ranked": closest_regions list} for a location, None when it has no data.
+        """
+        location_dict = self.cache.get(lat, long)
+        if location_dict is None:
+            location_dict = self.flights.do(quantize(lat, long), self.fetch, lat, long)
+            if location_dict is None:
+                return None
+            self.cache.set(lat, long, location_dict)
+        return {"location": location_dict, "ranked": closest_regions(location_dict, self.catalogue.reference, k)}
+
+    def submit(self, func, *args, wait=None):
+        """
+        Submits func to the pool, it holds one of the max_pending places until it finishes (not until a caller
+        gives up on it, so a hung worker keeps counting). Raises ServiceBusy when no place is free, after waiting
+        up to wait seconds for one when wait is given.
+        """
+        acquired = self.pending.acquire(timeout=wait) if wait is not None else self.pending.acquire(blocking=False)
+        if not acquired:
+            metrics.increment('service_rejected')
+            raise ServiceBusy('too many queries waiting, try again in a moment')
+        try:
+            future = self.pool.submit(func, *args)
+        except BaseException:
+            self.pending.release()
+            raise
+        future.add_done_callback(lambda future: self.pending.release())
+        return future
+
+    def result(self, future, timeout):
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()
+            metrics.increment('service_timeouts')
+            raise ServiceTimeout(f'no answer from a worker within {timeout}s') from None
+
+    def fetch(self, lat, long):
+        return self.result(self.submit(worker_query, lat, long, self.buffer), self.timeout)
+
+    def score_points(self, points, chunk_size=500):
+        """
+        Yields batch.score_points rows one chunk at a time, in input order, so a large job is never held in memory whole.
+        Chunks are spread over the worker processes with one per worker in flight, each counts against max_pending.
+        A chunk that fails or times out yields rows with its error, like batch.score_points.
+        """
+        points = batch.read_points(points)
+        in_flight = []
+        try:
+            with metrics.timer('service_score_points'):
+                for i in range(0, len(points), chunk_size):
+                    chunk = points[i:i + chunk_size]
+                    in_flight.append((chunk, self.submit(worker_score_points, chunk, self.buffer, wait=self.chunk_timeout)))
+                    if len(in_flight) == self.workers:
+                        yield self.chunk_rows(*in_flight.pop(0))
+                while in_flight:
+                    yield self.chunk_rows(*in_flight.pop(0))
+        finally:
+            # The client went away or the job failed, chunks that haven't started are dropped.
+            for chunk, future in in_flight:
+                future.cancel()
+
+    def chunk_rows(self, chunk, future):
+        try:
+            return self.result(future, self.chunk_timeout)
+        except Exception as e:
+            return [{"lat": lat, "lng": lng, "error": str(e)} for lat, lng in chunk]
+
+    def stats(self):
+        rows, counters = metrics.summary()
+        return {"timings": rows, "counters": counters, "coalesced": self.flights.shared}
+
+    def handle(self, method, kwargs):
+        handlers = {"query": self.query, "score_points": self.score_points, "stats": self.stats}
+        if method not in handlers:
+            raise ServiceError(f'unknown method {method}')
+        return handlers[method](**kwargs)
+
+    def replies(self, method, kwargs):
+        """
+        The messages answering one request: ("ok", value), or ("chunk", rows) per chunk of score_points
+        followed by ("ok", None), and ("error", message) as the last one when the request failed.
+        """
+        try:
+            value = self.handle(method, kwargs)
+            if method == "score_points":
+                for rows in value:
+                    yield ('chunk', rows)
+                value = None
+        except Exception as e:
+            yield ('error', f'{type(e).__name__}: {e}')
+        else:
+            yield ('ok', value)
+
+    def serve_connection(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, kwargs = connection.recv()
+                    for reply in self.replies(method, kwargs):
+                        connection.send(reply)
+                except (EOFError, OSError):
+                    return
+
+    def serve(self, address=service_address, authkey=None, ready=None):
+        """
+        Accepts clients until the process is stopped, one thread per connection.
+        authkey defaults to service_authkey, created when there is none yet.
+        ready, a threading.Event, is set once the service is listening.
+        """
+        authkey = authkey or service_authkey(create=True)
+        # Listener's default backlog of 1 drops clients that connect at the same time.
+        with Listener(address, backlog=128, authkey=authkey) as listener:
+            self.address = listener.address
+            if ready is not None:
+                ready.set()
+            while True:
+                try:
+                    connection = listener.accept()
+                except AuthenticationError:
+                    metrics.increment('service_auth_failures')
+                    continue
+                except (EOFError, ConnectionError):
+                    # The client hung up during the handshake.
+                    continue
+                threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ServiceClient:
+    """
+    Connection to a running ScoringService. One request at a time, so keep one client per session or thread.
+    A reply that doesn't come within timeout seconds raises ServiceTimeout, score_points waits chunk_timeout per chunk.
+    authkey defaults to service_authkey.
+    """
+
+    def __init__(self, address=service_address, authkey=None, timeout=30, chunk_timeout=900):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self.chunk_timeout = chunk_timeout
+        self.connection = None
+
+    def request(self, method, kwargs, timeout):
+        """
+        Sends a request and returns its first reply message.
+        """
+        # Reconnect once when the service was restarted since the last call.
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = Client(self.address, authkey=self.authkey or service_authkey())
+            try:
+                self.connection.send((method, kwargs))
+                return self.receive(timeout)
+            except (EOFError, OSError):
+                self.close()
+                if attempt == 1:
+                    raise
+
+    def receive(self, timeout):
+        if not self.connection.poll(timeout):
+            # The reply may still arrive later, so the connection can't be used for the next request.
+            self.close()
+            raise ServiceTimeout(f'no reply from the scoring service within {timeout}s')
+        status, value = self.connection.recv()
+        if status == 'error':
+            raise ServiceError(value)
+        return status, value
+
+    def call(self, method, **kwargs):
+        return self.request(method, kwargs, self.timeout)[1]
+
+    def query(self, lat, long, k=4):
+        return self.call('query', lat=lat, long=long, k=k)
+
+    def score_points(self, points, chunk_size=500):
+        """
+        Yields the result rows as the service sends each chunk.
+        """
+        status, value = self.request('score_points', {"points": batch.read_points(points), "chunk_size": chunk_size}, self.chunk_timeout)
+        try:
+            while status == 'chunk':
+                yield from value
+                status, value = self.receive(self.chunk_timeout)
+        finally:
+            # Stopped before the last chunk, the rest would arrive as the reply to the next request.
+            if status == 'chunk':
+                self.close()
+
+    def stats(self):
+        return self.call('stats')
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the scoring service the app and batch jobs submit queries to.')
+    parser.add_argument('--port', type=int, default=service_address[1])
+    parser.add_argument('--profiles', default='profiles.json')
+    parser.add_argument('--cache', default='cache/points.sqlite', help='SQLite point cache, "" to cache in memory')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-pending', type=int, default=64)
+    parser.add_argument('--timeout', type=float, default=20, help='seconds a query waits on its worker')
+    parser.add_argument('--fake', action='store_true', help='use backends.FakeBackend instead of Earth Engine')
+    args = parser.parse_args()
+
+    from backends import EarthEngineBackend, FakeBackend
+    service = ScoringService(FakeBackend if args.fake else EarthEngineBackend, profiles_path=args.profiles,
+                             cache=make_point_cache(args.cache, version=dataset_version), workers=args.workers,
+                             max_pending=args.max_pending, timeout=args.timeout)
+    print(f'scoring service listening on {service_address[0]}:{args.port}')
+    service.serve((service_address[0], args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from batch import sample_with_retry
+from cloud import dataset_version
+from compiled_catalogue import profiles_hash
+from data_analysis import point_profile_json
+from scoring import ReferenceMatrix, features, profile_vector, vector_profile
+
+# West, south, east, north of the grid, covers all of Canada.
+canada_bounds = (-141.0, 41.6, -52.6, 83.2)
+
+
+def grid_shape(bounds, resolution):
+    west, south, east, north = bounds
+    return int(np.ceil((north - south) / resolution)), int(np.ceil((east - west) / resolution))
+
+
+def cell_centers(bounds, resolution, rows, cols):
+    """
+    Returns (lat, lng) for the cells of one tile, row 0 is the northern edge of the grid.
+    """
+    west, south, east, north = bounds
+    return [(north - (row + 0.5) * resolution, west + (col + 0.5) * resolution) for row in rows for col in cols]
+
+
+def tile_key(bounds, resolution, tile_size):
+    """
+    Name of the tile directory of one grid, tiles from another grid or dataset version never line up with it.
+    """
+    key = json.dumps([list(bounds), resolution, tile_size, dataset_version])
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+def build_tile(tile_path, points, shape, backend, chunk_size, max_workers, retries, buffer):
+    """
+    Samples every cell of one tile and saves its (rows x cols x features) array, NaN where there is no data.
+    Written under a temporary name first so an interrupted run never leaves a half tile behind.
+    """
+    chunks = [points[i:i + chunk_size] for i in range(0, len(points), chunk_size)]
+    values = np.full((len(points), len(features)), np.nan, dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        sampled = executor.map(lambda chunk: sample_with_retry(backend, chunk, buffer, retries, 2), chunks)
+        i = 0
+        for chunk, chunk_points in zip(chunks, sampled):
+            for (lat, lng), point in zip(chunk, chunk_points):
+                if point is not None:
+                    values[i] = profile_vector(point_profile_json(point, lat, lng))
+                i += 1
+    np.save(tile_path + '.tmp.npy', values.reshape(shape + (len(features),)))
+    os.replace(tile_path + '.tmp.npy', tile_path)
+
+
+def build(out_dir, profiles, backend, bounds=canada_bounds, resolution=0.05, tile_size=64,
+          chunk_size=1000, max_workers=4, retries=3, buffer=1000):
+    """
+    Samples the grid tile by tile into out_dir/tiles, then scores it into memory-mappable layers:
+        features.npy       (rows x cols x features) sampled values
+        best_region.npy    (rows x cols) index into manifest regions, -1 where there is no data
+        best_score.npy     (rows x cols)
+        region_scores.npy  (regions x rows x cols) score against every region
+    Tiles already on disk are skipped so an interrupted build resumes where it stopped, and when only
+    profiles.json changed the layers are rescored from the saved tiles without touching Earth Engine.
+    Tiles are kept per grid and dataset version (tile_key), a build with other bounds, resolution, tile size
+    or datasets samples its own instead of reusing ones that don't line up.
+    """
+    tile_dir = os.path.join(out_dir, 'tiles', tile_key(bounds, resolution, tile_size))
+    os.makedirs(tile_dir, exist_ok=True)
+    n_rows, n_cols = grid_shape(bounds, resolution)
+
+    for row in range(0, n_rows, tile_size):
+        for col in range(0, n_cols, tile_size):
+            tile_path = os.path.join(tile_dir, f'{row}_{col}.npy')
+            rows = range(row, min(row + tile_size, n_rows))
+            cols = range(col, min(col + tile_size, n_cols))
+            if os.path.exists(tile_path) and np.load(tile_path, mmap_mode='r').shape[:2] == (len(rows), len(cols)):
+                continue
+            points = cell_centers(bounds, resolution, rows, cols)
+            build_tile(tile_path, points, (len(rows), len(cols)), backend, chunk_size, max_workers, retries, buffer)
+            print(f'tile {row}, {col} done')
+
+    reference = ReferenceMatrix.from_profiles(profiles)
+    grid = np.lib.format.open_memmap(os.path.join(out_dir, 'features.npy'), 'w+', np.float32, (n_rows, n_cols, len(features)))
+    best_region = np.lib.format.open_memmap(os.path.join(out_dir, 'best_region.npy'), 'w+', np.int16, (n_rows, n_cols))
+    best_score = np.lib.format.open_memmap(os.path.join(out_dir, 'best_score.npy'), 'w+', np.float32, (n_rows, n_cols))
+    region_scores = np.lib.format.open_memmap(os.path.join(out_dir, 'region_scores.npy'), 'w+', np.float32,
+                                              (len(reference.regions), n_rows, n_cols))
+    # Every cell is written below, these only show through if a tile is missing: no data rather than region 0.
+    grid[:] = np.nan
+    best_region[:] = -1
+    best_score[:] = np.nan
+    region_scores[:] = np.nan
+    for row in range(0, n_rows, tile_size):
+        for col in range(0, n_cols, tile_size):
+            tile = np.load(os.path.join(tile_dir, f'{row}_{col}.npy'))
+            h, w = tile.shape[:2]
+            grid[row:row + h, col:col + w] = tile
+            cells = tile.reshape(-1, len(features))
+            valid = ~np.isnan(cells).any(axis=1)
+            scores = np.full((len(cells), len(reference.regions)), np.nan, dtype=np.float32)
+            best = np.full(len(cells), -1)
+            if valid.any():
+                scores[valid] = reference.score(cells[valid])
+                best[valid] = scores[valid].argmin(axis=1)
+            best_region[row:row + h, col:col + w] = best.reshape(h, w)
+            best_score[row:row + h, col:col + w] = np.where(valid, scores[np.arange(len(cells)), best.clip(min=0)], np.nan).reshape(h, w)
+            region_scores[:, row:row + h, col:col + w] = scores.T.reshape(-1, h, w)
+    for layer in (grid, best_region, best_score, region_scores):
+        layer.flush()
+
+    manifest = {
+        "bounds": list(bounds),
+        "resolution": resolution,
+        "shape": [n_rows, n_cols],
+        "regions": reference.regions,
+        "features": features,
+        "profiles_hash": profiles_hash(profiles),
+        "dataset_version": dataset_version,
+    }
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        f.write(json.dumps(manifest, indent = 4))
+
+
+class SimilarityRaster:
+    """
+    Read-only view of a built raster, the layers are memory mapped so lookups don't load the grid.
+    """
+
+    def __init__(self, out_dir):
+        with open(os.path.join(out_dir, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.regions = self.manifest["regions"]
+        self.features = np.load(os.path.join(out_dir, 'features.npy'), mmap_mode='r')
+        self.best_region = np.load(os.path.join(out_dir, 'best_region.npy'), mmap_mode='r')
+        self.best_score = np.load(os.path.join(out_dir, 'best_score.npy'), mmap_mode='r')
+        self.region_scores = np.load(os.path.join(out_dir, 'region_scores.npy'), mmap_mode='r')
+
+    def is_current(self, catalogue_hash):
+        """
+        False when profiles.json changed since the raster was scored, catalogue_hash is ProfileCatalogue.profiles_hash,
+        or when it was sampled from other datasets (cloud.dataset_version).
+        """
+        return self.manifest["profiles_hash"] == catalogue_hash and self.manifest.get("dataset_version") == dataset_version
+
+    def cell(self, lat, long):
+        west, south, east, north = self.manifest["bounds"]
+        resolution = self.manifest["resolution"]
+        row, col = int((north - lat) // resolution), int((long - west) // resolution)
+        n_rows, n_cols = self.manifest["shape"]
+        if 0 <= row < n_rows and 0 <= col < n_cols:
+            return row, col
+        return None
+
+    def lookup(self, lat, long):
+        """
+        Returns (location_dict, closest region, score) for the cell holding the location, None if it has no data.
+        """
+        cell = self.cell(lat, long)
+        if cell is None or self.best_region[cell] < 0:
+            return None
+        location_dict = vector_profile(self.features[cell])
+        return location_dict, self.regions[self.best_region[cell]], round(float(self.best_score[cell]), 2)
+
+    def overlay(self, max_size=1000):
+        """
+        Returns (best region grid, bounds, number of regions) for drawing, strided down to at most max_size cells a side.
+        The grid's rows are resampled to web mercator (mercator_rows) so it lines up with the map when stretched over bounds.
+        """
+        step = max(1, int(np.ceil(max(self.best_region.shape) / max_size)))
+        west, south, east, north = self.manifest["bounds"]
+        grid = mercator_rows(np.asarray(self.best_region[::step, ::step]), south, north)
+        return grid, [[south, west], [north, east]], len(self.regions)
+
+
+def mercator_rows(grid, south, north):
+    """
+    Resamples a north-up grid with rows evenly spaced in latitude between south and north to rows evenly spaced
+    in web mercator, taking the nearest row. Nearest so region ids are never blended.
+    """
+    n_rows = grid.shape[0]
+    top, bottom = np.arcsinh(np.tan(np.radians([north, south])))
+    # Latitude of the centre of every output row, north to south.
+    lats = np.degrees(np.arctan(np.sinh(top - (np.arange(n_rows) + 0.5) / n_rows * (top - bottom))))
+    rows = np.clip(np.floor((north - lats) / (north - south) * n_rows).astype(int), 0, n_rows - 1)
+    return grid[rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the precomputed similarity raster for Canada.')
+    parser.add_argument('--out', default='similarity')
+    parser.add_argument('--profiles', default='profiles.json')
+    parser.add_argument('--resolution', type=float, default=0.05, help='cell size in degrees')
+    parser.add_argument('--tile-size', type=int, default=64, help='cells per tile side')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--fake', action='store_true', help='use backends.FakeBackend instead of Earth Engine')
+    args = parser.parse_args()
+
+    with open(args.profiles) as f:
+        profiles = json.load(f)
+    from backends import EarthEngineBackend, FakeBackend
+    backend = FakeBackend() if args.fake else EarthEngineBackend()
+    build(args.out, profiles, backend, resolution=args.resolution, tile_size=args.tile_size,
+          chunk_size=args.chunk_size, max_workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import functools
+import threading
+from concurrent.futures import Future
+from metrics import metrics
+
+
+def quantize(lat, long, cell_size=0.01):
+    """
+    Snaps a location to the same ~1 km grid point_cache uses, so nearby clicks share a key.
+    """
+    return round(lat / cell_size), round(long / cell_size)
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time, callers asking for a key that is already in flight
+    wait on the first call's future and get its result (or exception) instead of calling again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.in_flight[key] = future
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            metrics.increment('coalesced_calls')
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+
+def single_flight(key_func):
+    """
+    Decorator coalescing concurrent calls whose key_func(*args, **kwargs) is equal.
+    The SingleFlight is exposed as wrapper.group for its counters.
+    """
+    def decorator(func):
+        group = SingleFlight()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return group.do(key_func(*args, **kwargs), func, *args, **kwargs)
+        wrapper.group = group
+        return wrapper
+    return decorator
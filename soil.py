@@ -0,0 +1,78 @@
+import numpy as np
+
+# Row order of SoilProfile.values, same as queried_df.
+soil_types = ['Sand', 'Clay', 'Organic Matter']
+# Column order, the OpenLandMap depth bands and the labels queried_df shows for them.
+depth_bands = ['b0', 'b10', 'b30', 'b60', 'b100', 'b200']
+depth_labels = ['Surface', '10cm', '20cm', '60cm', '100cm', '200cm']
+
+# How the depth bands are combined into one value per soil type, weights are in depth_bands order.
+# thickness and root_zone use the trapezoid rule over the band depths (0, 10, 30, 60, 100, 200 cm),
+# root_zone only covers the top 100 cm.
+aggregation_weights = {
+    "mean": [1 / 6] * 6,
+    "thickness": [w / 200 for w in (5, 15, 25, 35, 70, 50)],
+    "root_zone": [w / 100 for w in (5, 15, 25, 35, 20, 0)],
+}
+
+
+class SoilProfile:
+    """
+    Soil fractions of one location as a fixed (soil types x depths) array, the values local_profile returns.
+    Does the depth aggregation and percentage conversion that queried_df, calculate_soil_mean and
+    make_queried_json used to do with DataFrames, build a DataFrame with to_dataframe only to display it.
+    When the aggregation was already done in Earth Engine (cloud.aggregate_soil) the array has a single column.
+    """
+    __slots__ = ('values', 'aggregation')
+
+    def __init__(self, values, aggregation='mean'):
+        self.values = np.asarray(values, dtype=float).reshape(len(soil_types), -1)
+        self.aggregation = aggregation
+
+    @classmethod
+    def from_bands(cls, sand_profile, clay_profile, orgc_profile, aggregation='mean'):
+        """
+        From the {band: value} dicts local_profile returns for sand, clay and organic carbon.
+        """
+        return cls([[profile[band] for band in depth_bands] for profile in (sand_profile, clay_profile, orgc_profile)], aggregation)
+
+    @classmethod
+    def from_aggregates(cls, sand, clay, orgc, aggregation='mean'):
+        """
+        From one already aggregated fraction per soil type.
+        """
+        return cls([[sand], [clay], [orgc]], aggregation)
+
+    def aggregates(self):
+        """
+        One fraction per soil type, in soil_types order.
+        """
+        if self.values.shape[1] == 1:
+            return self.values[:, 0]
+        if self.aggregation == 'mean':
+            return self.values.mean(axis=1)
+        return self.values @ np.array(aggregation_weights[self.aggregation])
+
+    def means(self):
+        """
+        {soil type: aggregated fraction} plus "Other", rounded like calculate_soil_mean.
+        """
+        # Rounded as numpy floats, the way calculate_soil_mean rounds the pandas means, so results match exactly.
+        means = {soil: round(mean, 3) for soil, mean in zip(soil_types, self.aggregates())}
+        means['Other'] = 1 - (means['Sand'] + means['Clay'] + means['Organic Matter'])
+        return means
+
+    def percentages(self):
+        """
+        The "mean_soil_content_%" dict of a location profile.
+        """
+        means = self.means()
+        return {soil: round(float(means[soil]) * 100, 2) for soil in ('Clay', 'Organic Matter', 'Other', 'Sand')}
+
+    def to_dataframe(self):
+        """
+        Same table as queried_df, for display.
+        """
+        import pandas
+        columns = depth_labels if self.values.shape[1] == len(depth_labels) else [self.aggregation]
+        return pandas.DataFrame(self.values, index=soil_types, columns=columns)
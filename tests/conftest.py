@@ -0,0 +1,66 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# The modules live at the repo root, imported the same way benchmarks/bench.py does.
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+
+
+class StubServer:
+    """
+    Local HTTP server standing in for an upstream service like geogratis.
+    Every GET is answered by respond(path), which returns (status, JSON body) and can be replaced by a test.
+    paths lists the requests it received.
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.respond = lambda path: (200, {})
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.paths.append(self.path)
+                status, body = stub.respond(self.path)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+
+@pytest.fixture
+def reference():
+    from scoring import ReferenceMatrix
+    with open(os.path.join(repo_root, 'profiles.json')) as f:
+        return ReferenceMatrix.from_profiles(json.load(f))
+
+
+@pytest.fixture
+def profiles_path():
+    return os.path.join(repo_root, 'profiles.json')
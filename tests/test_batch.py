@@ -0,0 +1,80 @@
+import csv
+import pandas
+import pytest
+import batch
+from backends import FakeBackend
+from data_analysis import comparison, point_profile_json
+
+
+class FlakyBackend(FakeBackend):
+    """
+    FakeBackend whose sample_points fails the first failures times it is called.
+    """
+
+    def __init__(self, failures=1, **kwargs):
+        super().__init__(**kwargs)
+        self.remaining_failures = failures
+        self.chunks = []
+
+    def sample_points(self, points, buffer):
+        self.chunks.append(len(points))
+        if self.remaining_failures:
+            self.remaining_failures -= 1
+            raise RuntimeError('sampleRegions failed')
+        return super().sample_points(points, buffer)
+
+
+points = [(45.0 + i / 100, -75.0 - i / 100) for i in range(25)]
+
+
+def test_rows_come_out_scored_in_input_order(reference):
+    backend = FlakyBackend(failures=0)
+    rows = list(batch.score_points(points, reference, backend, chunk_size=10, max_workers=2))
+
+    assert [(row["lat"], row["lng"]) for row in rows] == points
+    assert sorted(backend.chunks) == [5, 10, 10]
+    closest, scores = comparison(point_profile_json(backend.point_profile(), *points[0]), reference)
+    assert rows[0]["closest_region"] == closest
+    assert rows[0]["score"] == min(score["score"] for score in scores)
+
+
+def test_dataframe_input(reference):
+    frame = pandas.DataFrame(points[:3], columns=["lat", "lng"])
+    rows = list(batch.score_points(frame, reference, FakeBackend()))
+
+    assert [(row["lat"], row["lng"]) for row in rows] == points[:3]
+
+
+def test_failed_chunk_is_retried(reference):
+    backend = FlakyBackend(failures=2)
+    rows = list(batch.score_points(points[:5], reference, backend, retries=2, backoff=0))
+
+    assert backend.chunks == [5, 5, 5]
+    assert all("error" not in row for row in rows)
+
+
+def test_chunk_that_keeps_failing_yields_error_rows(reference):
+    backend = FlakyBackend(failures=100)
+    rows = list(batch.score_points(points, reference, backend, chunk_size=10, retries=1, backoff=0))
+
+    assert len(rows) == len(points)
+    assert all(row["error"] == 'sampleRegions failed' for row in rows)
+
+
+def test_points_without_data(reference):
+    backend = FakeBackend()
+    backend.sample_points = lambda chunk, buffer: [None for _ in chunk]
+    rows = list(batch.score_points(points[:2], reference, backend))
+
+    assert [row["error"] for row in rows] == ["no data", "no data"]
+
+
+def test_write_csv(reference, tmp_path):
+    path = tmp_path / 'scores.csv'
+    batch.write_csv(batch.score_points(points, reference, FakeBackend(), chunk_size=10), path, reference)
+
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == len(points)
+    assert set(f'score_{region}' for region in reference.regions) <= set(rows[0])
+    assert float(rows[0]["lat"]) == pytest.approx(points[0][0])
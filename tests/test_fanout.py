@@ -0,0 +1,81 @@
+import time
+import pytest
+import data_analysis
+from backends import FakeBackend
+from data_analysis import fetch_point_concurrently, make_queried_json_concurrently, point_profile_json
+from http_client import JsonClient
+
+
+def test_lookups_run_concurrently():
+    backend = FakeBackend(latency=0.2)
+    start = time.monotonic()
+    location, errors = make_queried_json_concurrently(backend, 45.0, -75.0)
+    elapsed = time.monotonic() - start
+
+    assert errors == {}
+    assert location == point_profile_json(backend.point_profile(), 45.0, -75.0)
+    # Six lookups of 0.2s each, one after another would take 1.2s.
+    assert elapsed < 0.6
+
+
+def test_slow_lookup_times_out_without_blocking_the_rest():
+    backend = FakeBackend(latency={"elevation": 2})
+    start = time.monotonic()
+    results, errors = fetch_point_concurrently(backend, 45.0, -75.0, timeout=0.3)
+
+    assert time.monotonic() - start < 1
+    assert set(errors) == {"elevation"}
+    assert isinstance(errors["elevation"], TimeoutError)
+    assert set(results) == {"sand", "clay", "orgc", "mean_temp", "avg_diurnal_range"}
+
+
+def test_failed_lookup_is_reported():
+    backend = FakeBackend(failures={"location_temp": RuntimeError("earth engine down")})
+    location, errors = make_queried_json_concurrently(backend, 45.0, -75.0)
+
+    assert location is None
+    assert set(errors) == {"mean_temp"}
+
+
+def test_missing_soil_data_is_an_error():
+    backend = FakeBackend()
+    backend.soil_profile = lambda param, poi, buffer: 'No data :('
+    location, errors = make_queried_json_concurrently(backend, 45.0, -75.0)
+
+    assert location is None
+    assert set(errors) == {"sand", "clay", "orgc"}
+
+
+class GeogratisBackend(FakeBackend):
+    """
+    FakeBackend whose elevation goes through data_analysis.get_elevation, falling back to fallback_altitude.
+    """
+
+    fallback_altitude = -1.0
+
+    def elevation(self, lat, long):
+        return data_analysis.get_elevation(lat, long, fallback=lambda lat, long: self.fallback_altitude)['altitude']
+
+
+@pytest.fixture
+def geogratis(stub_server, monkeypatch):
+    monkeypatch.setattr(data_analysis, 'geogratis_url', f'{stub_server.url}/altitude')
+    monkeypatch.setattr(data_analysis, '_geogratis_client', JsonClient(timeout=(1, 1), retries=0))
+    return stub_server
+
+
+def test_elevation_from_fake_server(geogratis):
+    geogratis.respond = lambda path: (200, {"altitude": 123.4})
+    location, errors = make_queried_json_concurrently(GeogratisBackend(), 45.1, -75.1)
+
+    assert errors == {}
+    assert location["mean_elevation"] == 123.4
+    assert geogratis.paths == ['/altitude?lat=45.1&lon=-75.1']
+
+
+def test_elevation_falls_back_when_the_server_fails(geogratis):
+    geogratis.respond = lambda path: (503, {})
+    location, errors = make_queried_json_concurrently(GeogratisBackend(), 45.2, -75.2)
+
+    assert errors == {}
+    assert location["mean_elevation"] == GeogratisBackend.fallback_altitude
@@ -0,0 +1,81 @@
+import logging
+import threading
+import pytest
+import data_analysis
+from http_client import CircuitBreaker, CircuitOpenError, JsonClient
+
+
+def open_breaker(reset_timeout=0):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_threshold():
+    breaker = open_breaker(reset_timeout=60)
+    assert not breaker.allow()
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = open_breaker()
+    barrier = threading.Barrier(10)
+    allowed = []
+
+    def call():
+        barrier.wait()
+        allowed.append(breaker.allow())
+
+    threads = [threading.Thread(target=call) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert allowed.count(True) == 1
+
+
+def test_successful_trial_closes_the_circuit():
+    breaker = open_breaker()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_trial_reopens_the_circuit():
+    breaker = open_breaker()
+    assert breaker.allow()
+    breaker.reset_timeout = 60
+    breaker.record_failure()
+    assert not breaker.allow()
+
+
+def test_retries_server_errors(stub_server):
+    responses = iter([(503, {}), (200, {"altitude": 10})])
+    stub_server.respond = lambda path: next(responses)
+    client = JsonClient(timeout=(1, 1), retries=2, backoff=0)
+
+    assert client.get_json(f'{stub_server.url}/altitude') == {"altitude": 10}
+    assert len(stub_server.paths) == 2
+
+
+def test_open_circuit_makes_no_request(stub_server):
+    stub_server.respond = lambda path: (500, {})
+    client = JsonClient(timeout=(1, 1), retries=0)
+    client.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    for _ in range(2):
+        with pytest.raises(Exception):
+            client.get_json(stub_server.url)
+
+    with pytest.raises(CircuitOpenError):
+        client.get_json(stub_server.url)
+    assert len(stub_server.paths) == 2
+
+
+def test_elevation_falls_back_with_a_warning(stub_server, monkeypatch, caplog):
+    stub_server.respond = lambda path: (500, {})
+    monkeypatch.setattr(data_analysis, 'geogratis_url', stub_server.url)
+    monkeypatch.setattr(data_analysis, '_geogratis_client', JsonClient(timeout=(1, 1), retries=0))
+
+    with caplog.at_level(logging.WARNING, logger='vineyard.data_analysis'):
+        assert data_analysis.get_elevation(46.0, -72.0, fallback=lambda lat, long: 55.0) == {"altitude": 55.0}
+    assert 'falling back' in caplog.text
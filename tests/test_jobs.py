@@ -0,0 +1,26 @@
+from concurrent.futures import Future
+from jobs import PointJob
+from metrics import metrics
+
+
+def finished(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def cancelled_jobs():
+    return metrics.counters.get('jobs_cancelled', 0)
+
+
+def test_only_pending_jobs_count_as_cancelled():
+    before = cancelled_jobs()
+    PointJob(45.0, -75.0, {"temp": finished(10.0), "elevation": finished(100.0)}).cancel()
+    assert cancelled_jobs() == before
+
+    job = PointJob(45.0, -75.0, {"temp": finished(10.0), "elevation": Future()})
+    job.cancel()
+    job.cancel()
+    assert cancelled_jobs() == before + 1
+    assert not job.matches(45.0, -75.0)
+    assert job.result('elevation')[1] is not None
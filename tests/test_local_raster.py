@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from local_raster import LocalRasterBackend, NumpyTileSource, point_bands, write_numpy_tiles
+
+# 100 x 100 cells of 0.01 degrees, row 0 along the northern edge.
+bounds = (-80.0, 59.5, -79.0, 60.5)
+resolution = 0.01
+
+
+class RecordingSource(NumpyTileSource):
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.shapes = []
+
+    def read_window(self, band, lat, long, lat_radius, long_radius):
+        window = super().read_window(band, lat, long, lat_radius, long_radius)
+        self.shapes.append(window.shape)
+        return window
+
+
+@pytest.fixture
+def directory(tmp_path):
+    rows, cols = np.indices((100, 100))
+    layers = {band: np.full((100, 100), 10.0) for band in point_bands}
+    # Each temperature cell holds its own position, the other layers are constant.
+    layers['temp'] = rows * 1000.0 + cols
+    # The north-west corner has no data.
+    for band in point_bands:
+        layers[band][:10, :10] = np.nan
+    write_numpy_tiles(str(tmp_path), bounds, resolution, layers)
+    return str(tmp_path)
+
+
+def test_point_lookups_read_the_cell_holding_the_point(directory):
+    backend = LocalRasterBackend.open(directory)
+
+    assert backend.location_temp(60.0 - 0.005, -79.5 + 0.005) == 50 * 1000 + 50
+    assert backend.elevation(60.0, -79.5) == 10
+    assert backend.query_point((-79.5, 60.0), 30).mean_temp == 50 * 1000 + 50
+
+
+def test_longitude_radius_widens_with_latitude(directory):
+    source = RecordingSource(directory)
+    backend = LocalRasterBackend(source)
+    # 2.5 cells of latitude either side, about five of longitude at 60 degrees north, whole cells are read.
+    backend.read('elevation', 60.0, -79.5, 2 * 111320 * 0.025)
+
+    assert source.shapes == [(5, 9)]
+
+
+def test_nodata_is_ignored_or_missing(directory):
+    backend = LocalRasterBackend.open(directory)
+
+    assert backend.location_temp(60.5 - 0.005, -80.0 + 0.005) is None
+    assert backend.soil_profile('sand', (-79.995, 60.495), 30) == 'No data :('
+    assert backend.query_point((-79.995, 60.495), 30) is None
+    # A window straddling the corner averages the cells that have data.
+    assert backend.read('elevation', 60.5 - 0.095, -80.0 + 0.095, 2 * 111320 * 0.02) == 10
+
+
+def test_points_outside_the_grid_have_no_data(directory):
+    backend = LocalRasterBackend.open(directory)
+
+    assert backend.location_temp(45.0, -75.0) is None
+    assert backend.query_point((-81.0, 60.0), 30) is None
+    assert backend.sample_points([(60.0, -79.5), (61.0, -79.5)], 30)[1] is None
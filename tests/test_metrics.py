@@ -0,0 +1,41 @@
+import time
+import requests
+import metrics
+from metrics import Registry, serve_prometheus, timed
+
+
+def test_timed_calls_are_exported(monkeypatch):
+    registry = Registry()
+    monkeypatch.setattr(metrics, 'metrics', registry)
+
+    @timed('lookup')
+    def lookup():
+        time.sleep(0.003)
+        registry.increment('lookups')
+        return 'ok'
+
+    assert lookup() == 'ok'
+    assert lookup() == 'ok'
+    registry.increment('cache_hits', 3)
+    registry.set_gauge('queue_depth', 2)
+
+    rows, values = registry.summary()
+    assert [(row["stage"], row["count"]) for row in rows] == [('lookup', 2)]
+    assert rows[0]["mean_s"] >= 0.003
+    # At least 3 ms, so past the 2.5 ms bucket.
+    assert rows[0]["p50_s"] >= 0.005
+    assert values == {"lookups": 2, "cache_hits": 3, "queue_depth": 2}
+
+    server = serve_prometheus(0, registry)
+    try:
+        text = requests.get(f'http://127.0.0.1:{server.server_address[1]}/metrics', timeout=5).text
+    finally:
+        server.shutdown()
+    lines = text.splitlines()
+    assert '# TYPE vineyard_lookup_seconds histogram' in lines
+    assert 'vineyard_lookup_seconds_bucket{le="0.0025"} 0' in lines
+    assert 'vineyard_lookup_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'vineyard_lookup_seconds_count 2' in lines
+    assert 'vineyard_lookups_total 2' in lines
+    assert 'vineyard_cache_hits_total 3' in lines
+    assert 'vineyard_queue_depth 2' in lines
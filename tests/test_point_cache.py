@@ -0,0 +1,74 @@
+import itertools
+import pytest
+import point_cache
+from point_cache import MemoryStore, PointCache, SQLiteStore, make_point_cache
+
+location = {"mean_temp": 10.0, "mean_elevation": 100.0}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Fake time.time for point_cache, advanced by hand; each reading also moves it on a millisecond so
+    SQLiteStore's used_at never ties.
+    """
+    now = {"offset": 0.0}
+    ticks = itertools.count()
+    monkeypatch.setattr(point_cache.time, 'time', lambda: 1e9 + now["offset"] + next(ticks) / 1000)
+    return now
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def make_store(request, tmp_path):
+    def make(max_entries):
+        if request.param == 'memory':
+            return MemoryStore(max_entries)
+        return SQLiteStore(str(tmp_path / 'points.sqlite'), max_entries)
+    return make
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = PointCache(MemoryStore(), ttl=60)
+    cache.set(45.0, -75.0, location)
+
+    clock["offset"] = 30
+    assert cache.get(45.0, -75.0) == location
+    clock["offset"] = 61
+    assert cache.get(45.0, -75.0) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    # The expired entry was dropped from the store.
+    assert cache.store.get(cache.key(45.0, -75.0)) is None
+
+
+def test_least_recently_used_is_evicted_at_capacity(clock, make_store):
+    cache = PointCache(make_store(max_entries=2))
+    cache.set(45.0, -75.0, {"n": 1})
+    cache.set(46.0, -75.0, {"n": 2})
+    # Reading the first entry makes the second the least recently used.
+    assert cache.get(45.0, -75.0) == {"n": 1}
+    cache.set(47.0, -75.0, {"n": 3})
+
+    assert cache.get(45.0, -75.0) == {"n": 1}
+    assert cache.get(46.0, -75.0) is None
+    assert cache.get(47.0, -75.0) == {"n": 3}
+
+
+def test_sqlite_entries_survive_reopening(tmp_path):
+    path = str(tmp_path / 'cache' / 'points.sqlite')
+    make_point_cache(path, version='v1').set(45.0, -75.0, location)
+
+    reopened = make_point_cache(path, version='v1')
+    assert reopened.get(45.0, -75.0) == location
+    # Clicks in the same cell share the entry.
+    assert reopened.get(45.001, -75.001) == location
+
+
+def test_key_changes_with_dataset_version(tmp_path):
+    path = str(tmp_path / 'points.sqlite')
+    old = make_point_cache(path, version='v1')
+    old.set(45.0, -75.0, location)
+    new = make_point_cache(path, version='v2')
+
+    assert new.key(45.0, -75.0) != old.key(45.0, -75.0)
+    assert new.get(45.0, -75.0) is None
+    assert old.get(45.0, -75.0) == location
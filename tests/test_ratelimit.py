@@ -0,0 +1,185 @@
+import threading
+import time
+import ee
+import httplib2
+import pytest
+import requests
+from googleapiclient.errors import HttpError
+import batch
+import cloud
+from backends import ThrottlingBackend, TooManyRequests
+from ratelimit import BATCH, BUILD, INTERACTIVE, AdaptiveLimiter, is_retryable, is_throttled, priority
+
+
+def ee_error(status, message='Earth Engine error'):
+    # How the Earth Engine client reports an HTTP error, an EEException raised while handling the HttpError.
+    try:
+        raise HttpError(httplib2.Response({"status": status}), b'')
+    except HttpError:
+        try:
+            raise ee.EEException(message)
+        except ee.EEException as e:
+            return e
+
+
+def http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def test_throttling_is_recognized_by_status():
+    assert is_throttled(ee_error(429, 'Too many concurrent aggregations.'))
+    assert is_throttled(http_error(429))
+    assert is_throttled(TooManyRequests())
+
+
+def test_other_errors_are_not_throttling():
+    assert not is_throttled(ee_error(400, 'Image.load: Image asset "users/x/dem_4291" not found.'))
+    assert not is_throttled(ee.EEException('Computed value is too large: 429 MB'))
+    assert not is_throttled(ValueError('429'))
+
+
+def test_retryable_errors():
+    assert is_retryable(ee_error(503))
+    assert is_retryable(http_error(429))
+    assert not is_retryable(ee_error(400))
+    assert not is_retryable(RuntimeError('down'))
+
+
+def fast_limiter(**kwargs):
+    options = dict(rate=1000, burst=1000, backoff=0.001)
+    options.update(kwargs)
+    return AdaptiveLimiter(**options)
+
+
+def test_call_retries_throttled_requests():
+    limiter = fast_limiter(retries=3)
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise TooManyRequests()
+        return 'ok'
+
+    assert limiter.call(request) == 'ok'
+    assert len(attempts) == 3
+
+
+def test_call_does_not_retry_other_errors():
+    limiter = fast_limiter(retries=3)
+    attempts = []
+
+    def request():
+        attempts.append(1)
+        raise ee_error(400)
+
+    with pytest.raises(ee.EEException):
+        limiter.call(request)
+    assert len(attempts) == 1
+
+
+def test_limit_halves_on_throttling_and_grows_back():
+    limiter = fast_limiter(limit=8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.limit == 4
+    for _ in range(8):
+        limiter.acquire()
+        limiter.release()
+    assert 5 < limiter.limit < 6
+
+
+def test_waiters_are_served_by_priority():
+    limiter = fast_limiter(limit=1)
+    limiter.acquire()
+    served = []
+
+    def wait(level, name):
+        limiter.acquire(level)
+        served.append(name)
+        limiter.release()
+
+    threads = []
+    for level, name in [(BUILD, 'build'), (BATCH, 'batch'), (INTERACTIVE, 'click')]:
+        threads.append(threading.Thread(target=wait, args=(level, name)))
+        threads[-1].start()
+        time.sleep(0.05)
+    limiter.release()
+    for thread in threads:
+        thread.join()
+    assert served == ['click', 'batch', 'build']
+
+
+def test_acquire_times_out():
+    limiter = fast_limiter(limit=1)
+    limiter.acquire()
+    with pytest.raises(TimeoutError):
+        limiter.acquire(timeout=0.1)
+    assert limiter.waiting == []
+
+
+def test_simulated_throttling_backend(monkeypatch):
+    limiter = fast_limiter(limit=8, retries=10)
+    monkeypatch.setattr(cloud, 'limiter', limiter)
+    backend = ThrottlingBackend(max_concurrent=3, latency=0.02)
+    errors = []
+
+    def click():
+        try:
+            backend.query_point((-75.0, 45.0), 1000)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=click) for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert backend.throttled > 0
+    # The limiter backed off from its starting limit towards what the backend allows.
+    assert limiter.limit < 8
+
+
+def test_batch_leaves_throttled_chunks_to_the_limiter(monkeypatch):
+    monkeypatch.setattr(cloud, 'limiter', fast_limiter(retries=2))
+    backend = ThrottlingBackend(max_concurrent=0)
+
+    with pytest.raises(TooManyRequests):
+        batch.sample_with_retry(backend, [(45.0, -75.0)], 1000, retries=3, backoff=0)
+    # 3 attempts from the limiter, none added by batch on top.
+    assert backend.throttled == 3
+
+
+def test_batch_requests_run_at_batch_priority(monkeypatch):
+    levels = []
+
+    class RecordingLimiter(AdaptiveLimiter):
+        def acquire(self, level=INTERACTIVE, timeout=None):
+            levels.append(level)
+            return super().acquire(level, timeout)
+
+    monkeypatch.setattr(cloud, 'limiter', RecordingLimiter(rate=1000, burst=1000))
+    batch.sample_with_retry(ThrottlingBackend(), [(45.0, -75.0)], 1000, retries=0, backoff=0)
+    with priority(BUILD):
+        ThrottlingBackend().query_point((-75.0, 45.0), 1000)
+    assert levels == [BATCH, BUILD]
+
+
+def test_only_limited_calls_skip_client_retries(monkeypatch):
+    retries = []
+
+    class Call:
+        def execute(self, num_retries):
+            retries.append(num_retries)
+
+    monkeypatch.setattr(cloud, 'limiter', fast_limiter())
+    monkeypatch.setattr(ee.data, '_execute_cloud_call', lambda call, num_retries=ee.data.MAX_RETRIES: call.execute(num_retries))
+    cloud._install_retry_switch()
+
+    cloud.limited_call(lambda: ee.data._execute_cloud_call(Call()))
+    ee.data._execute_cloud_call(Call())
+    assert retries == [0, ee.data.MAX_RETRIES]
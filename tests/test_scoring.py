@@ -0,0 +1,34 @@
+import numpy as np
+from data_analysis import closest_regions, comparison
+from scoring import ReferenceMatrix, features, vector_profile
+
+
+def tied_reference(n_regions=40, seed=0):
+    # Few distinct values per feature, so many regions tie on score.
+    rng = np.random.default_rng(seed)
+    return ReferenceMatrix([f'region {i}' for i in range(n_regions)], rng.integers(0, 3, (n_regions, len(features))))
+
+
+def test_top_k_matches_a_stable_sort_of_every_region():
+    reference = tied_reference()
+    queries = np.random.default_rng(1).integers(0, 3, (200, len(features)))
+    order, ranked_scores = reference.rank(queries)
+    for k in (1, 3, 10):
+        indices, scores = reference.top_k(queries, k)
+        assert (indices == order[:, :k]).all()
+        assert (scores == ranked_scores[:, :k]).all()
+
+
+def test_closest_region_agrees_with_comparison():
+    reference = tied_reference()
+    for query in np.random.default_rng(2).integers(0, 3, (100, len(features))):
+        profile = vector_profile(query)
+        closest, _ = comparison(profile, reference)
+        assert closest_regions(profile, reference, k=1)[0]["region"] == closest
+
+
+def test_k_larger_than_the_catalogue():
+    reference = tied_reference(n_regions=3)
+    indices, scores = reference.top_k(np.zeros(len(features)), k=5)
+    assert indices.shape == (1, 3)
+    assert sorted(indices[0]) == [0, 1, 2]
@@ -0,0 +1,138 @@
+import os
+import stat
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+import pytest
+import service
+from backends import FakeBackend
+from service import ScoringService, ServiceBusy, ServiceClient, ServiceError, ServiceTimeout
+
+authkey = b'test-key'
+
+
+def start(profiles_path, **kwargs):
+    """
+    A ScoringService on FakeBackend listening on a free port, with its worker processes already started.
+    """
+    kwargs.setdefault('backend_options', {})
+    scoring = ScoringService(FakeBackend, profiles_path=profiles_path, **kwargs)
+    # Spawning the workers takes a moment, don't let it count against the timeouts under test.
+    for future in [scoring.pool.submit(pow, 2, 2) for _ in range(scoring.workers)]:
+        future.result()
+    ready = threading.Event()
+    threading.Thread(target=scoring.serve, args=(('127.0.0.1', 0), authkey, ready), daemon=True).start()
+    ready.wait(10)
+    return scoring
+
+
+@pytest.fixture
+def make_service(profiles_path):
+    services = []
+
+    def make(**kwargs):
+        services.append(start(profiles_path, **kwargs))
+        return services[-1]
+    yield make
+    for scoring in services:
+        scoring.close()
+
+
+def test_query_end_to_end(make_service):
+    scoring = make_service(workers=1)
+    client = ServiceClient(scoring.address, authkey)
+    answer = client.query(45.0, -75.0, k=3)
+
+    assert answer["location"]["mean_temp"] == FakeBackend().temp
+    assert len(answer["ranked"]) == 3
+    assert client.query(45.0, -75.0, k=3) == answer
+    assert "service_query" in [row["stage"] for row in client.stats()["timings"]]
+    client.close()
+
+
+def test_queries_beyond_max_pending_are_refused(make_service):
+    scoring = make_service(workers=1, max_pending=1, backend_options={"latency": {"query_point": 1}})
+    slow = threading.Thread(target=scoring.query, args=(45.0, -75.0))
+    slow.start()
+    time.sleep(0.2)
+
+    with pytest.raises(ServiceBusy):
+        scoring.query(46.0, -76.0)
+    slow.join()
+    # The place is free again once the first query finished.
+    assert scoring.query(46.0, -76.0) is not None
+
+
+def test_hung_worker_times_out(make_service):
+    scoring = make_service(workers=1, max_pending=1, timeout=0.3, backend_options={"latency": {"query_point": 1.5}})
+    client = ServiceClient(scoring.address, authkey)
+
+    start_time = time.monotonic()
+    with pytest.raises(ServiceError, match='ServiceTimeout'):
+        client.query(45.0, -75.0)
+    assert time.monotonic() - start_time < 1
+    # The hung worker still holds its place until it actually finishes.
+    with pytest.raises(ServiceBusy):
+        scoring.query(46.0, -76.0)
+
+
+def test_client_gives_up_on_a_slow_reply(make_service):
+    scoring = make_service(workers=1, backend_options={"latency": {"query_point": 1}})
+    client = ServiceClient(scoring.address, authkey, timeout=0.3)
+
+    with pytest.raises(ServiceTimeout):
+        client.query(45.0, -75.0)
+    assert client.connection is None
+    # The next call uses a new connection instead of reading the late reply.
+    client.timeout = 10
+    answer = client.query(46.0, -76.0)
+    assert answer["location"] is not None
+
+
+def test_score_points_streams_rows_in_order(make_service):
+    scoring = make_service(workers=2)
+    points = [(45.0 + i / 100, -75.0) for i in range(25)]
+    rows = ServiceClient(scoring.address, authkey).score_points(points, chunk_size=10)
+
+    assert not isinstance(rows, list)
+    assert [(row["lat"], row["lng"]) for row in rows] == points
+
+
+def test_batch_chunks_count_against_max_pending(make_service):
+    scoring = make_service(workers=1, max_pending=1, backend_options={"latency": {"sample_points": 1}})
+    rows = []
+    job = threading.Thread(target=lambda: [rows.extend(chunk) for chunk in scoring.score_points([(45.0, -75.0)] * 20, chunk_size=10)])
+    job.start()
+    time.sleep(0.3)
+
+    with pytest.raises(ServiceBusy):
+        scoring.query(46.0, -76.0)
+    job.join()
+    assert len(rows) == 20 and all("error" not in row for row in rows)
+
+
+def test_wrong_key_is_refused(make_service):
+    scoring = make_service(workers=1)
+    with pytest.raises(AuthenticationError):
+        Client(scoring.address, authkey=b'guessed')
+    # The service keeps accepting clients with the right key.
+    assert ServiceClient(scoring.address, authkey).query(45.0, -75.0) is not None
+
+
+def test_authkey_is_generated_once(tmp_path, monkeypatch):
+    monkeypatch.delenv('VINEYARD_SERVICE_KEY', raising=False)
+    path = str(tmp_path / 'service.key')
+    with pytest.raises(ServiceError):
+        service.service_authkey(path=path)
+
+    key = service.service_authkey(create=True, path=path)
+    assert len(key) == 64
+    assert service.service_authkey(create=True, path=path) == key == service.service_authkey(path=path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert key != service.service_authkey(create=True, path=str(tmp_path / 'other.key'))
+
+
+def test_authkey_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv('VINEYARD_SERVICE_KEY', 'from-env')
+    assert service.service_authkey(path=str(tmp_path / 'missing.key')) == b'from-env'
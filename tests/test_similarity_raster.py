@@ -0,0 +1,51 @@
+import json
+import numpy as np
+import pytest
+import similarity_raster
+from backends import FakeBackend
+from compiled_catalogue import profiles_hash
+from similarity_raster import SimilarityRaster, build
+
+bounds = (-78.4, 41.6, -77.6, 42.4)
+
+
+@pytest.fixture
+def profiles(profiles_path):
+    with open(profiles_path) as f:
+        return json.load(f)
+
+
+def test_rebuild_with_another_tile_size_samples_its_own_tiles(tmp_path, profiles):
+    build(str(tmp_path), profiles, FakeBackend(), bounds=bounds, resolution=0.1, tile_size=2)
+    backend = FakeBackend()
+    build(str(tmp_path), profiles, backend, bounds=bounds, resolution=0.1, tile_size=4)
+    raster = SimilarityRaster(str(tmp_path))
+
+    assert backend.calls > 0
+    assert (np.asarray(raster.best_region) >= 0).all()
+    location, region, score = raster.lookup(41.95, -78.05)
+    assert location["mean_temp"] == FakeBackend().temp
+    assert score > 0
+
+
+def test_cells_without_data_are_not_region_zero(tmp_path, profiles):
+    backend = FakeBackend()
+    backend.sample_points = lambda points, buffer: [None for _ in points]
+    build(str(tmp_path), profiles, backend, bounds=bounds, resolution=0.1, tile_size=4)
+    raster = SimilarityRaster(str(tmp_path))
+
+    assert (np.asarray(raster.best_region) == -1).all()
+    assert np.isnan(raster.features).all()
+    assert raster.lookup(41.95, -78.05) is None
+
+
+def test_raster_from_other_datasets_is_not_current(tmp_path, profiles, monkeypatch):
+    build(str(tmp_path), profiles, FakeBackend(), bounds=bounds, resolution=0.2, tile_size=4)
+    assert SimilarityRaster(str(tmp_path)).is_current(profiles_hash(profiles))
+
+    monkeypatch.setattr(similarity_raster, 'dataset_version', 'other')
+    assert not SimilarityRaster(str(tmp_path)).is_current(profiles_hash(profiles))
+    # Its tiles aren't reused either.
+    backend = FakeBackend()
+    build(str(tmp_path), profiles, backend, bounds=bounds, resolution=0.2, tile_size=4)
+    assert backend.calls > 0
@@ -0,0 +1,74 @@
+import threading
+import time
+import pytest
+from singleflight import single_flight
+
+
+def call_concurrently(func, callers):
+    """
+    Runs func() from callers threads, returns each one's result or exception.
+    """
+    outcomes = [None] * callers
+
+    def run(i):
+        try:
+            outcomes[i] = func()
+        except Exception as e:
+            outcomes[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+
+def wait_for_followers(group, followers):
+    deadline = time.monotonic() + 5
+    while group.shared < followers and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert group.shared == followers
+
+
+def test_concurrent_identical_calls_run_once_and_share_the_result():
+    release = threading.Event()
+    calls = []
+
+    @single_flight(lambda lat, long: (lat, long))
+    def lookup(lat, long):
+        calls.append((lat, long))
+        release.wait(5)
+        return {"lat": lat, "long": long}
+
+    threads, outcomes = call_concurrently(lambda: lookup(45.0, -75.0), 5)
+    wait_for_followers(lookup.group, 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [(45.0, -75.0)]
+    assert all(outcome is outcomes[0] for outcome in outcomes)
+    assert (lookup.group.calls, lookup.group.shared) == (1, 4)
+
+
+def test_exception_reaches_every_waiter_and_releases_the_key():
+    release = threading.Event()
+    attempts = []
+
+    @single_flight(lambda key: key)
+    def fail(key):
+        attempts.append(key)
+        release.wait(5)
+        raise RuntimeError('upstream failed')
+
+    threads, outcomes = call_concurrently(lambda: fail('a'), 3)
+    wait_for_followers(fail.group, 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert attempts == ['a']
+    assert fail.group.in_flight == {}
+    # The next call for the key runs the function again.
+    with pytest.raises(RuntimeError):
+        fail('a')
+    assert attempts == ['a', 'a']
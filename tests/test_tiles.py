@@ -0,0 +1,50 @@
+import logging
+import threading
+from types import SimpleNamespace
+import requests
+import cloud
+from tiles import TileRenderer, serve_tiles
+
+
+class SlowImage:
+    def __init__(self, release):
+        self.release = release
+
+    def getMapId(self, visualization):
+        self.release.wait(5)
+        return {"tile_fetcher": SimpleNamespace(url_format='https://earthengine.test/{z}/{x}/{y}')}
+
+
+def test_waiting_map_id_does_not_hold_up_other_layers(tmp_path, monkeypatch):
+    release = {"sand": threading.Event(), "temp": threading.Event()}
+    release["temp"].set()
+    monkeypatch.setattr(cloud, 'get_image', lambda name, build=None: SlowImage(release[name[len('layer_'):]]))
+    monkeypatch.setattr(cloud, 'limited_call', lambda func, *args, **kwargs: func(*args, **kwargs))
+    renderer = TileRenderer(str(tmp_path))
+
+    sand = threading.Thread(target=renderer.ee_url, args=('sand',))
+    sand.start()
+    try:
+        temp = threading.Thread(target=renderer.ee_url, args=('temp',))
+        temp.start()
+        temp.join(2)
+        assert not temp.is_alive()
+    finally:
+        release["sand"].set()
+        sand.join()
+    assert set(renderer.map_ids) == {'sand', 'temp'}
+
+
+def test_failed_tiles_are_logged(caplog):
+    def tile(layer, zoom, x, y):
+        raise RuntimeError('no map id')
+
+    server = serve_tiles(0, SimpleNamespace(layers=['sand'], tile=tile))
+    try:
+        with caplog.at_level(logging.WARNING, logger='vineyard.tiles'):
+            response = requests.get(f'http://127.0.0.1:{server.server_address[1]}/tiles/sand/3/1/2.png', timeout=5)
+    finally:
+        server.shutdown()
+
+    assert response.status_code == 502
+    assert any('/tiles/sand/3/1/2.png failed' in record.getMessage() for record in caplog.records)
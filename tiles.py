@@ -0,0 +1,255 @@
+import argparse
+import logging
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ee
+import numpy as np
+import cloud
+from metrics import metrics, timed
+from ratelimit import BATCH, run_at
+from similarity_raster import SimilarityRaster, canada_bounds
+
+logger = logging.getLogger('vineyard.tiles')
+
+# Rendered tiles, one directory per dataset version and layer: {layer}/{z}/{x}/{y}.png
+tile_cache_dir = 'cache/tiles'
+tile_size = 256
+# Earth Engine map ids stop working after a while, they are requested again after this many seconds.
+map_id_ttl = 3600
+
+# Low to high, used for every Earth Engine layer.
+data_palette = ['f7fcb9', 'addd8e', '41ab5d', '006837', '00441b']
+# The similarity layer goes from close (green) to far (red).
+score_palette = [(26, 152, 80), (255, 255, 191), (215, 48, 39)]
+
+# name: (image builder, visualization parameters), the builders go through cloud.get_image so each is built once.
+ee_layers = {
+    "sand": (lambda: cloud.aggregate_soil(cloud.get_data("sand")), {"min": 0, "max": 1}),
+    "clay": (lambda: cloud.aggregate_soil(cloud.get_data("clay")), {"min": 0, "max": 1}),
+    "orgc": (lambda: cloud.aggregate_soil(cloud.get_data("orgc")), {"min": 0, "max": 0.05}),
+    "elev": (lambda: cloud.get_image("cdem"), {"min": 0, "max": 2000}),
+    "temp": (lambda: cloud.get_image("temp"), {"min": -15, "max": 15}),
+    "diurnal": (lambda: cloud.get_image("diurnal_months").reduce(ee.Reducer.mean()), {"min": 5, "max": 20}),
+}
+
+tile_path_pattern = re.compile(r'^/tiles/(\w+)/(\d+)/(\d+)/(\d+)\.png$')
+
+
+def tile_range(bounds, zoom):
+    """
+    (x, y) of every tile at zoom that overlaps bounds (west, south, east, north).
+    """
+    west, south, east, north = bounds
+    n = 2 ** zoom
+
+    def tile_xy(lat, long):
+        lat = max(min(lat, 85.0511), -85.0511)
+        x = int((long + 180) / 360 * n)
+        y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+        return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+    x0, y0 = tile_xy(north, west)
+    x1, y1 = tile_xy(south, east)
+    return [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def pixel_centers(zoom, x, y):
+    """
+    Latitudes (tile_size x 1) and longitudes (1 x tile_size) of a web mercator tile's pixel centres.
+    """
+    n = 2 ** zoom
+    offsets = (np.arange(tile_size) + 0.5) / tile_size
+    longs = (x + offsets) / n * 360 - 180
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+    return lats[:, None], longs[None, :]
+
+
+def colourize(values, vmin, vmax, palette, alpha=180):
+    """
+    RGBA image of values interpolated along palette, NaNs are transparent.
+    """
+    stops = np.linspace(0, 1, len(palette))
+    scaled = np.nan_to_num(np.clip((values - vmin) / max(vmax - vmin, 1e-9), 0, 1))
+    image = np.zeros(values.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        image[..., channel] = np.interp(scaled, stops, [colour[channel] for colour in palette])
+    image[..., 3] = np.where(np.isnan(values), 0, alpha)
+    return image
+
+
+class TileRenderer:
+    """
+    Renders XYZ tiles for the ee_layers and, when a similarity raster is given, its best score.
+    Every tile is written to cache_dir the first time it is asked for, Earth Engine tiles are fetched
+    from the layer's map id, similarity tiles are drawn from the memory mapped raster.
+    """
+
+    def __init__(self, cache_dir=tile_cache_dir, raster=None, session=None):
+        self.cache_dir = cache_dir
+        self.raster = raster
+        self.session = session
+        # One lock per layer, a layer waiting on its map id doesn't hold up the others.
+        self.locks = {layer: threading.Lock() for layer in ee_layers}
+        self.map_ids = {}
+        self.score_range = None
+
+    @property
+    def layers(self):
+        return list(ee_layers) + (['similarity'] if self.raster is not None else [])
+
+    def version(self, layer):
+        if layer == 'similarity':
+            # Scores change with the profiles and with the datasets they were sampled from.
+            return f'{self.raster.manifest["profiles_hash"][:12]}_{self.raster.manifest.get("dataset_version")}'
+        return cloud.dataset_version
+
+    def ee_url(self, layer):
+        """
+        The Earth Engine {z}/{x}/{y} url of a layer, its map id is requested again after map_id_ttl.
+        """
+        with self.locks[layer]:
+            url, created = self.map_ids.get(layer, (None, 0))
+            if url is None or time.monotonic() - created > map_id_ttl:
+                build, visualization = ee_layers[layer]
+                image = cloud.get_image(f'layer_{layer}', build)
+                with metrics.timer('ee_get_map_id'):
+                    map_id = cloud.limited_call(image.getMapId, dict(visualization, palette=data_palette))
+                url = map_id['tile_fetcher'].url_format
+                self.map_ids[layer] = (url, time.monotonic())
+            return url
+
+    def tile(self, layer, zoom, x, y):
+        """
+        PNG bytes of one tile, from the cache when it was rendered before.
+        """
+        path = os.path.join(self.cache_dir, self.version(layer), layer, str(zoom), str(x), f'{y}.png')
+        if os.path.exists(path):
+            metrics.increment('tile_cache_hits')
+            with open(path, 'rb') as f:
+                return f.read()
+        metrics.increment('tile_cache_misses')
+        png = self.render(layer, zoom, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a per-thread name and moved into place, concurrent requests for a tile never see half of it.
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(png)
+        os.replace(temporary, path)
+        return png
+
+    @timed('render_tile')
+    def render(self, layer, zoom, x, y):
+        if layer == 'similarity':
+            return self.render_similarity(zoom, x, y)
+        if self.session is None:
+            from http_client import make_session
+            self.session = make_session()
+        response = self.session.get(self.ee_url(layer).format(z=zoom, x=x, y=y), timeout=(3.05, 20))
+        response.raise_for_status()
+        return response.content
+
+    def render_similarity(self, zoom, x, y):
+        from folium.utilities import write_png
+        raster = self.raster
+        if self.score_range is None:
+            # Colour scale from the spread of scores, outliers would otherwise wash everything out.
+            scores = np.asarray(raster.best_score)
+            self.score_range = tuple(np.nanpercentile(np.where(np.asarray(raster.best_region) >= 0, scores, np.nan), [2, 98]))
+        west, south, east, north = raster.manifest["bounds"]
+        resolution = raster.manifest["resolution"]
+        n_rows, n_cols = raster.manifest["shape"]
+        lats, longs = pixel_centers(zoom, x, y)
+        rows = np.floor((north - lats) / resolution).astype(int)
+        cols = np.floor((longs - west) / resolution).astype(int)
+        inside = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+        rows, cols = np.clip(rows, 0, n_rows - 1), np.clip(cols, 0, n_cols - 1)
+        has_data = inside & (raster.best_region[rows, cols] >= 0)
+        values = np.where(has_data, raster.best_score[rows, cols], np.nan)
+        return write_png(colourize(values, *self.score_range, score_palette))
+
+    def prerender(self, layers=None, zooms=(3, 4, 5, 6), bounds=canada_bounds, max_workers=8):
+        """
+        Fills the cache with every tile of layers over bounds at zooms, returns how many tiles that was.
+        """
+        jobs = [(layer, zoom, x, y) for layer in layers or self.layers for zoom in zooms for x, y in tile_range(bounds, zoom)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for i, _ in enumerate(executor.map(lambda job: run_at(BATCH, self.tile, *job), jobs)):
+                print(f'\r{i + 1}/{len(jobs)} tiles', end='')
+        print()
+        return len(jobs)
+
+
+def serve_tiles(port, renderer, host='127.0.0.1'):
+    """
+    Serves renderer's tiles at /tiles/{layer}/{z}/{x}/{y}.png on host:port from a background thread.
+    Only this machine can reach it on the default host, listen on '0.0.0.0' or put it behind a proxy for browsers elsewhere.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            match = tile_path_pattern.match(self.path)
+            if match is None or match.group(1) not in renderer.layers:
+                self.send_response(404)
+                self.end_headers()
+                return
+            try:
+                png = renderer.tile(match.group(1), *(int(group) for group in match.groups()[1:]))
+            except Exception as e:
+                logger.warning(f'tile {self.path} failed: {e!r}')
+                self.send_response(502)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Cache-Control', 'max-age=86400')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(png)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def layer_urls(renderer, base_url=None):
+    """
+    {layer: XYZ url} for folium. Through the caching server when base_url, the address browsers reach serve_tiles at,
+    is given, otherwise straight from Earth Engine (the similarity layer needs the server).
+    """
+    if base_url is not None:
+        base_url = base_url.rstrip('/')
+        return {layer: f'{base_url}/tiles/{layer}/{{z}}/{{x}}/{{y}}.png' for layer in renderer.layers}
+    return {layer: renderer.ee_url(layer) for layer in ee_layers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render map tiles into the tile cache ahead of time, or serve them with --serve.')
+    parser.add_argument('--layers', nargs='+', default=None, help='default: every Earth Engine layer, plus similarity with --raster')
+    parser.add_argument('--zooms', nargs='+', type=int, default=[3, 4, 5, 6])
+    parser.add_argument('--cache', default=tile_cache_dir)
+    parser.add_argument('--raster', default=None, help='similarity_raster.py output directory')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--serve', type=int, default=None, metavar='PORT', help='serve tiles on PORT instead of prerendering')
+    parser.add_argument('--host', default='127.0.0.1', help='interface --serve listens on')
+    args = parser.parse_args()
+    raster = SimilarityRaster(args.raster) if args.raster else None
+    renderer = TileRenderer(args.cache, raster)
+    if args.serve is not None:
+        serve_tiles(args.serve, renderer, args.host)
+        print(f'serving tiles on {args.host}:{args.serve}')
+        # serve_tiles runs in a daemon thread, keep the process alive for it.
+        threading.Event().wait()
+    else:
+        renderer.prerender(args.layers, args.zooms, max_workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()